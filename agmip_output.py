@@ -0,0 +1,121 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import json
+
+import numpy as np
+
+import experiment_tables
+
+# AgMIP reports the soil water at these depths on top of the bottom depths of the soil profile layers
+TOP_OUTPUT_DEPTHS_CM = (5,)
+
+
+def sim_layer_thicknesses_cm(sim_json):
+    "the thicknesses [cm] of MONICA's simulation layers as configured by NumberOfLayers and LayerThickness"
+    thickness = sim_json.get("LayerThickness", [0.1, "m"])
+    thickness_m = thickness[0] if isinstance(thickness, list) else thickness
+    return [thickness_m * 100.0] * int(sim_json.get("NumberOfLayers", 20))
+
+
+def output_depths_cm(soil_layer_bottoms_cm, top_depths_cm=TOP_OUTPUT_DEPTHS_CM):
+    "the (sorted, unique) bottom depths [cm] of the output layers for a soil profile"
+    return sorted(set(float(d) for d in soil_layer_bottoms_cm) | set(float(d) for d in top_depths_cm))
+
+
+def layer_weights(output_depths, sim_layer_thicknesses):
+    """
+    create the (simulation layers x output layers) weight matrix, each output layer (from the previous output depth
+    to its own depth) is the thickness weighted mean of the simulation layers it overlaps,
+    output layers below the simulated profile get NaN weights
+    """
+    sim_bottoms = np.cumsum(sim_layer_thicknesses)
+    sim_tops = sim_bottoms - np.asarray(sim_layer_thicknesses)
+    weights = np.zeros((len(sim_layer_thicknesses), len(output_depths)), dtype=np.float64)
+    top = 0.0
+    for col, bottom in enumerate(output_depths):
+        overlaps = np.clip(np.minimum(sim_bottoms, bottom) - np.maximum(sim_tops, top), 0.0, None)
+        total = overlaps.sum()
+        weights[:, col] = overlaps / total if total > 0 else np.nan
+        top = bottom
+    return weights
+
+
+class SoilLayerWeights:
+    "the output layer weight matrices for the soils in Soil_layers.csv, created on first use"
+
+    def __init__(self, path_to_soil_layers_csv, path_to_sim_json, top_depths_cm=TOP_OUTPUT_DEPTHS_CM):
+        self.soil_layers = experiment_tables.load_table(path_to_soil_layers_csv)
+        with open(path_to_sim_json) as _:
+            self.sim_layer_thicknesses = sim_layer_thicknesses_cm(json.load(_))
+        self.top_depths_cm = top_depths_cm
+        self.soil_name_to_weights = {}
+
+    def output_depths(self, soil_name):
+        "the bottom depths [cm] of the soil's output layers or None if the soil is not in Soil_layers.csv"
+        rows = self.soil_layers.index("SOIL_NAME").get(soil_name, None)
+        if rows is None:
+            return None
+        return output_depths_cm(self.soil_layers["SLLB"][rows].tolist(), self.top_depths_cm)
+
+    def max_no_of_output_layers(self):
+        "the number of SWC columns needed for the soil with the most output layers"
+        return max((len(self.output_depths(soil_name)) for soil_name in self.soil_layers.index("SOIL_NAME")),
+                   default=0)
+
+    def get(self, soil_name):
+        "the weight matrix for the soil or None if the soil is not in Soil_layers.csv"
+        weights = self.soil_name_to_weights.get(soil_name, None)
+        if weights is None:
+            depths = self.output_depths(soil_name)
+            if depths is None:
+                return None
+            weights = layer_weights(depths, self.sim_layer_thicknesses)
+            self.soil_name_to_weights[soil_name] = weights
+        return weights
+
+
+def daily_header_rows(no_of_swc_columns):
+    "the two header rows (descriptions and codes) of the AgMIP daily output with the given number of SWC columns"
+    return [
+        ["Tret: 1 to 13", "Day after planting", "Zadocks phenology stage", "Total above biomass", "Leaf Area Index",
+         "Daily transpiration", "Actual evapotranspiration", "Runoff", "Deep Percolation", "N Leaching"]
+        + [f"Soil Water Content_layer_{i}" for i in range(1, no_of_swc_columns + 1)],
+        ["Treatment", "DAP", "ZDPH", "CWAD", "LAI", "TRANS", "ETa", "Roff", "DPER", "NLEA"]
+        + ["SWC"] * no_of_swc_columns
+    ]
+
+
+def daily_rows(trt_no, columns, weights, no_of_swc_columns=None):
+    """
+    the AgMIP daily output rows (Treatment, DAP, ZDPH, CWAD, LAI, TRANS, ETa, Roff, DPER, NLEA, SWC ...)
+    for the daily results of a treatment as output name -> column (see monica_io3.output_columns),
+    DAP counts from the first result's date, soils with fewer output layers get empty SWC cells up to no_of_swc_columns
+    """
+    if len(columns.get("Date", [])) == 0:
+        return []
+    dates = np.array(columns["Date"], dtype="datetime64[D]")
+    daps = (dates - dates[0]).astype(np.int64).tolist()
+    # days x simulation layers -> days x output layers
+    swcs = (np.array(columns["SWC"], dtype=np.float64) @ weights).tolist()
+    if no_of_swc_columns is not None and no_of_swc_columns > weights.shape[1]:
+        padding = [""] * (no_of_swc_columns - weights.shape[1])
+        swcs = [layer_swcs + padding for layer_swcs in swcs]
+    return [[trt_no, dap, stage, cwad, lai, trans, eta, roff, dper[0], nlea] + layer_swcs
+            for dap, stage, cwad, lai, trans, eta, roff, dper, nlea, layer_swcs
+            in zip(daps, columns["Stage"], columns["CWAD"], columns["LAI"], columns["TRANS"], columns["ETa"],
+                   columns["Roff"], columns["DPER"], columns["NLEA"], swcs)]
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+from datetime import datetime
+
+import numpy as np
+
+# outputs which are dates, they are compared as day of year
+DOY_OUTPUT_NAMES = ("Z31D", "ADAT", "MDAT")
+# outputs derived from other outputs
+DERIVED_OUTPUT_NAMES = {"HIAM": ("GWAM", "CWAM")}
+
+
+def sim_values(output_name_to_result, output_names):
+    "the simulated values of a treatment for the (observed) output names, NaN if missing"
+    values = []
+    for output_name in output_names:
+        if output_name == "HIAM":
+            gwam = output_name_to_result.get("GWAM", None)
+            cwam = output_name_to_result.get("CWAM", None)
+            values.append(gwam / cwam * 100.0 if gwam is not None and cwam is not None else np.nan)
+            continue
+        v = output_name_to_result.get(output_name, None)
+        if v is None:
+            values.append(np.nan)
+        elif output_name in DOY_OUTPUT_NAMES:
+            values.append(int(datetime.fromisoformat(v).timetuple().tm_yday))
+        else:
+            values.append(v)
+    return values
+
+
+class SimVector:
+    """
+    matches the results of a candidate's treatments against the observations, the simulated vector has
+    the observations' order (treatments ascending, per treatment the output names)
+    """
+
+    def __init__(self, trt_nos, output_names):
+        self.trt_nos = sorted(trt_nos)
+        self.output_names = list(output_names)
+        self.trt_no_to_offset = {trt_no: i * len(self.output_names) for i, trt_no in enumerate(self.trt_nos)}
+        # just these outputs have to be kept from MONICA's results
+        self.needed_output_names = set()
+        for output_name in self.output_names:
+            self.needed_output_names.update(DERIVED_OUTPUT_NAMES.get(output_name, (output_name,)))
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls(spec["trt_nos"], spec["outputs"])
+
+    def spec(self):
+        "the json representation, e.g. to ship the matching to the consumer"
+        return {"trt_nos": self.trt_nos, "outputs": self.output_names}
+
+    def values(self, output_name_to_result):
+        return sim_values(output_name_to_result, self.output_names)
+
+    def vector(self, trt_no_to_output_name_to_result):
+        "the simulated vector, treatments without results are NaN"
+        vec = np.full(len(self.trt_nos) * len(self.output_names), np.nan)
+        for trt_no, output_name_to_result in trt_no_to_output_name_to_result.items():
+            offset = self.trt_no_to_offset.get(int(trt_no), None)
+            if offset is not None:
+                vec[offset:offset + len(self.output_names)] = self.values(output_name_to_result)
+        return vec
@@ -0,0 +1,136 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import copy
+import csv
+from decimal import Decimal
+
+
+def read_calibration_params(path_to_params_csv):
+    "read the parameters to be calibrated from a calibratethese csv file"
+    params = []
+    with open(path_to_params_csv) as params_csv:
+        dialect = csv.Sniffer().sniff(params_csv.read(), delimiters=';,\t')
+        params_csv.seek(0)
+        reader = csv.reader(params_csv, dialect)
+        next(reader, None)  # skip the header
+        for row in reader:
+            p = {"name": row[0]}
+            if len(row[1]) > 0:
+                p["array"] = row[1].split("|")
+            for n, i in [("low", 2), ("high", 3), ("step", 4), ("optguess", 5), ("minbound", 6), ("maxbound", 7)]:
+                if len(row[i]) > 0:
+                    p[n] = float(row[i])
+            if len(row) == 9 and len(row[8]) > 0:
+                p["derive_function"] = lambda _, _2, expr=row[8]: eval(expr)
+            params.append(p)
+    return params
+
+
+def calibration_param_name(param):
+    "the (unique) name the parameter is known by in spotpy and in the messages to the producer"
+    if "array" in param:
+        return f"{param['name']}_{'_'.join(param['array'])}"
+    return param["name"]
+
+
+def sent_param_names(params):
+    "the names of the parameters which are actually sampled by spotpy (and thus sent to the producer)"
+    return [calibration_param_name(p) for p in params if "derive_function" not in p]
+
+
+def quantize(value, low=None, step=None, high=None):
+    "snap the value to the grid of the parameter's step (starting at low), values without step stay as they are"
+    if not step:
+        return value
+    origin = low if low is not None else 0.0
+    q = origin + round((value - origin) / step) * step
+    if high is not None and q > high:
+        q -= step
+    if low is not None and q < low:
+        q = low
+    # remove the floating point noise, so the values are written like the step
+    return round(q, max(0, -Decimal(repr(step)).as_tuple().exponent, -Decimal(repr(origin)).as_tuple().exponent))
+
+
+def _unwrap_value_with_unit(container, name):
+    "replace a [value, unit] pair by the plain value"
+    old_val = container[name]
+    if isinstance(old_val, list) and len(old_val) > 1 and isinstance(old_val[1], str):
+        container[name] = old_val[0]
+
+
+class ParameterSetters:
+    """
+    setters for calibration parameters like 'CriticalOxygenContent_3', resolved once
+    to the container (species, cultivar or user crop parameters) and index they set
+    """
+
+    def __init__(self, species, cultivar, user_crop_params):
+        self.maps = [("species", species), ("cultivar", cultivar), ("userCropParameters", user_crop_params)]
+        self.setters = {}  # name -> (container, key)
+
+    def _resolve(self, full_name):
+        name_arr = full_name.split("_")
+        name = name_arr[0]
+        indices = [int(i) - 1 for i in name_arr[1:3]]  # for the user we start counting at 1
+        for map_name, params in self.maps:
+            if name in params:
+                break
+            if "=" in params and name in params["="]:
+                # the parameter is only defined in the included base map, so override it at the top level
+                params[name] = copy.deepcopy(params["="][name])
+                break
+        else:
+            raise ValueError(f"Calibration parameter '{full_name}': '{name}' is neither a species, "
+                             f"cultivar nor user crop parameter!")
+
+        _unwrap_value_with_unit(params, name)
+        container = params
+        key = name
+        for i in indices:
+            val = container[key]
+            if not isinstance(val, list) or not (0 <= i < len(val)):
+                raise ValueError(f"Calibration parameter '{full_name}': index {i + 1} is invalid for "
+                                 f"{map_name} parameter '{name}'!")
+            container = val
+            key = i
+        return container, key
+
+    def compile(self, names):
+        "resolve all names, raises a ValueError listing all names which can't be resolved"
+        errors = []
+        for name in names:
+            if name in self.setters:
+                continue
+            try:
+                self.setters[name] = self._resolve(name)
+            except ValueError as e:
+                errors.append(str(e))
+        if len(errors) > 0:
+            raise ValueError("\n".join(errors))
+
+    def apply(self, params):
+        "set all parameter values, unknown names will be compiled on first use"
+        setters = self.setters
+        for name, value in params.items():
+            setter = setters.get(name, None)
+            if setter is None:
+                self.compile([name])
+                setter = setters[name]
+            container, key = setter
+            container[key] = value
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import csv
+
+import numpy as np
+
+
+def read_results_csv(path_to_csv):
+    """
+    read the objective values and parameter sets (name -> value) of a spotpy results csv (like1 and parNAME columns)
+    in the order they were evaluated
+    """
+    likes = []
+    param_sets = []
+    with open(path_to_csv, newline="") as _:
+        reader = csv.DictReader(_)
+        par_cols = [c for c in reader.fieldnames or [] if c.startswith("par")]
+        for row in reader:
+            try:
+                like = float(row["like1"])
+                params = {c[3:]: float(row[c]) for c in par_cols}
+            except (KeyError, TypeError, ValueError):
+                continue  # e.g. the incomplete last line of an aborted run
+            likes.append(like)
+            param_sets.append(params)
+    return likes, param_sets
+
+
+def best_param_sets(path_to_csv, n):
+    "the (distinct) parameter sets of the n lowest objective values in the results csv, best first"
+    likes, param_sets = read_results_csv(path_to_csv)
+    best = []
+    seen = set()
+    for i in np.argsort(likes, kind="stable"):
+        if np.isnan(likes[i]):
+            continue
+        key = tuple(sorted(param_sets[i].items()))
+        if key in seen:
+            continue
+        seen.add(key)
+        best.append(param_sets[i])
+        if len(best) == n:
+            break
+    return best
+
+
+def seed_initial_population(sampler, param_sets):
+    """
+    let the sampler's initial population (the sceua burn-in, the first sampled input matrix) start with the given
+    parameter sets,
+    parameters are mapped by name, values outside of the current bounds are clipped and
+    parameters unknown to the param sets keep their random sample, returns the number of mapped parameters
+    """
+    pars = sampler.parameter()
+    names = list(pars["name"])
+    mapped = set(names).intersection(*param_sets) if param_sets else set()
+    random_sample = sampler._sampleinputmatrix
+
+    def sample_input_matrix(nrows, npars):
+        # just the burn-in is seeded, the later (single) random points of the sampler stay random
+        sampler._sampleinputmatrix = random_sample
+        x = random_sample(nrows, npars)
+        for row, params in zip(x, param_sets[:nrows]):
+            for col, name in enumerate(names):
+                if name in params:
+                    row[col] = np.clip(params[name], pars["minbound"][col], pars["maxbound"][col])
+        return x
+
+    sampler._sampleinputmatrix = sample_input_matrix
+    return len(mapped)
+
+
+def repetitions_to_reach(likes, target):
+    "the number of repetitions until the objective value was at or below the target the first time, None if never"
+    below = np.flatnonzero(np.asarray(likes, dtype=np.float64) <= target)
+    return int(below[0]) + 1 if len(below) > 0 else None
+
+
+def convergence_report(path_to_csv, path_to_reference_csv=None, name="warm start", reference_name="cold start"):
+    """
+    lines comparing the repetitions it took to reach the best objective value of the run with a reference run
+    (e.g. a cold start on the same treatments), both runs are measured against the worse of their best values
+    """
+    likes, _ = read_results_csv(path_to_csv)
+    if len(likes) == 0:
+        return [f"{name}: no results in {path_to_csv}"]
+    best = np.nanmin(likes)
+    lines = [f"{name}: best objective value {best:g} after {repetitions_to_reach(likes, best)} "
+             f"of {len(likes)} repetitions"]
+    if not path_to_reference_csv:
+        return lines
+    ref_likes, _ = read_results_csv(path_to_reference_csv)
+    if len(ref_likes) == 0:
+        return lines + [f"{reference_name}: no results in {path_to_reference_csv}"]
+    ref_best = np.nanmin(ref_likes)
+    target = max(best, ref_best)
+    reps = repetitions_to_reach(likes, target)
+    ref_reps = repetitions_to_reach(ref_likes, target)
+    lines.append(f"{reference_name}: best objective value {ref_best:g} after {repetitions_to_reach(ref_likes, ref_best)} "
+                 f"of {len(ref_likes)} repetitions")
+    lines.append(f"repetitions to reach {target:g}: {name}: {reps} {reference_name}: {ref_reps}"
+                 + (f" ({ref_reps / reps:.2f}x)" if reps and ref_reps else ""))
+    return lines
@@ -16,10 +16,15 @@
 # Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
 
 import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import threading
 from threading import Thread
 
 import capnp
+import csv
 from datetime import datetime
+import hashlib
 import json
 import numpy as np
 import os
@@ -27,39 +32,253 @@ from pathlib import Path
 from queue import SimpleQueue
 import spotpy
 
+import calibration_objective
+import calibration_params
 import common
 
 fbp_capnp = capnp.load("capnp_schemas/fbp.capnp", imports=[])
+calibration_capnp = capnp.load("capnp_schemas/calibration.capnp", imports=[])
 
 
-def start_thread(prod_writer_sr, prod_writer_queue: SimpleQueue, cons_reader_sr, cons_reader_queue: SimpleQueue):
+def start_thread(prod_writer_sr, prod_writer_queue: SimpleQueue, cons_reader_sr, on_result, channel_host=None):
+    """
+    send the queued parameter sets and hand the received results (which may arrive out of order) to on_result,
+    streamed results of single treatments come with their trt_no, the results are either the simulated values
+    (list) or json text, channels hosted by the (local_channel) channel_host are used directly instead of via RPC
+    """
+    async def send(write):
+        loop = asyncio.get_running_loop()
+        while True:
+            out_ip = await loop.run_in_executor(None, prod_writer_queue.get)
+            await write(out_ip)
+
+    async def receive(read):
+        while True:
+            msg = await read()
+            in_ip = msg.value.as_struct(fbp_capnp.IP)
+            candidate = common.get_fbp_attr(in_ip, "candidate")
+            trt_no = common.get_fbp_attr(in_ip, "trt_no")
+            content_type = common.get_fbp_attr(in_ip, "content_type")
+            if content_type is not None and content_type.as_text() == "ResultMatrix":
+                content = list(in_ip.content.as_struct(calibration_capnp.ResultMatrix).values)
+            else:
+                content = in_ip.content.as_text()  # json
+            on_result(candidate.as_text() if candidate is not None else None, content,
+                      int(trt_no.as_text()) if trt_no is not None else None)
+
     async def send_receive():
         async with capnp.kj_loop():
             con_man = common.ConnectionManager()
             cons_reader = await con_man.try_connect(cons_reader_sr, cast_as=fbp_capnp.Channel.Reader, retry_secs=1)
             prod_writer = await con_man.try_connect(prod_writer_sr, cast_as=fbp_capnp.Channel.Writer, retry_secs=1)
-            while True:
-                out_ip = prod_writer_queue.get()
-                await prod_writer.write(value=out_ip)
-                msg = await cons_reader.read()
-                cons_reader_queue.put(msg.value.as_struct(fbp_capnp.IP))
+            await asyncio.gather(send(lambda ip: prod_writer.write(value=ip)), receive(cons_reader.read))
+
+    prod_chan = channel_host.channel(prod_writer_sr) if channel_host else None
+    cons_chan = channel_host.channel(cons_reader_sr) if channel_host else None
+    if prod_chan and cons_chan:
+        async def send_receive_local():
+            await asyncio.gather(send(prod_chan.write_value), receive(cons_chan.read))
+
+        channel_host.run(send_receive_local()).result()
+    else:
+        asyncio.run(send_receive())
+
+
+class BatchForEach(object):
+    """
+    spotpy repeater (see spotpy.parallel) which keeps up to max_workers candidates in the MONICA pipeline,
+    spotpy's own code still runs one at a time, the setup's lock is just released while waiting for MONICA,
+    results are given back in the order of the jobs (like spotpy's 'mpc')
+    """
+
+    def __init__(self, process, setup, max_workers):
+        self.process = process
+        self.setup = setup
+        self.max_workers = max_workers
+        self.phase = None
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="spotpy_candidate")
+
+    def is_idle(self):
+        return False
+
+    def terminate(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def setphase(self, phasename):
+        self.phase = phasename
+
+    def start(self):
+        pass
+
+    def _run(self, job):
+        with self.setup.lock:
+            self.setup.local.batched = True
+            try:
+                return self.process(job)
+            finally:
+                self.setup.local.batched = False
+
+    @staticmethod
+    def _copy_job(job):
+        # jobs of parallel processes get their own copy of the (numpy) state, e.g. the sceua complexes
+        if isinstance(job, tuple):
+            return tuple(j.copy() if isinstance(j, np.ndarray) else j for j in job)
+        return job
+
+    def __call__(self, jobs):
+        lock = self.setup.lock
+        lock.acquire()
+        self.setup.next_round()
+        futures = [self.pool.submit(self._run, self._copy_job(job)) for job in jobs]
+        try:
+            for future in futures:
+                lock.release()
+                try:
+                    result = future.result()
+                finally:
+                    lock.acquire()
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
+            lock.release()
+
+
+class EvaluationCache(object):
+    """
+    simulation results by the (quantized) parameter values, appended as json lines to the cache file,
+    only results evaluated in the same context (parameters, treatments, outputs) are loaded again
+    """
+
+    def __init__(self, path_to_file, context):
+        self.path_to_file = path_to_file
+        self.context = hashlib.sha1(json.dumps(context, sort_keys=True).encode("utf-8")).hexdigest()
+        self.key_to_sim = {}
+        self.key_to_future = {}  # evaluations in flight
+        self.hits = 0
+        self.misses = 0
+        if path_to_file and os.path.exists(path_to_file):
+            with open(path_to_file) as _:
+                for line in _:
+                    entry = json.loads(line)
+                    if entry.get("context", None) == self.context:
+                        self.key_to_sim[self.key(entry["params"])] = entry["sim"]
+
+    @staticmethod
+    def key(params):
+        return json.dumps(params, sort_keys=True)
+
+    def lookup(self, key):
+        "the cached results, the future of the results in flight or None, then the caller has to evaluate and put"
+        if key in self.key_to_sim:
+            self.hits += 1
+            return self.key_to_sim[key]
+        if key in self.key_to_future:
+            self.hits += 1
+            return self.key_to_future[key]
+        self.misses += 1
+        self.key_to_future[key] = Future()
+        return None
+
+    def put(self, key, sim_list, complete=True):
+        "the results of the evaluation, partial ones (aborted or not promoted) just go to the evaluations in flight"
+        future = self.key_to_future.pop(key, None)
+        if future:
+            future.set_result(sim_list)
+        if not complete:
+            return
+        self.key_to_sim[key] = sim_list
+        if self.path_to_file:
+            with open(self.path_to_file, "a") as _:
+                _.write(json.dumps({"context": self.context, "params": json.loads(key), "sim": sim_list}) + "\n")
+
+    def add_results_csv(self, path_to_csv, name_to_grid):
+        """
+        add the evaluations recorded in a spotpy results csv (parNAME and simulation_N columns) to the memory only,
+        the csv is the record of them, the parameter values are snapped to the grid,
+        returns the number of added parameter sets
+        """
+        added = 0
+        with open(path_to_csv, newline="") as _:
+            reader = csv.DictReader(_)
+            sim_cols = sorted((c for c in reader.fieldnames or [] if c.startswith("simulation_")),
+                              key=lambda c: int(c.split("_")[1]))
+            for row in reader:
+                try:
+                    params = {name: calibration_params.quantize(float(row[f"par{name}"]), *grid)
+                              for name, grid in name_to_grid.items()}
+                    sim_list = [float(row[c]) for c in sim_cols]
+                except (KeyError, TypeError, ValueError):
+                    continue  # e.g. the incomplete last line of an aborted run
+                key = self.key(params)
+                if key not in self.key_to_sim:
+                    self.key_to_sim[key] = sim_list
+                    added += 1
+        return added
+
+    def discard(self, key, exception):
+        future = self.key_to_future.pop(key, None)
+        if future:
+            future.set_exception(exception)
+
+    def format_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100.0 if lookups > 0 else 0.0
+        return f"evaluation cache hits: {self.hits} misses: {self.misses} ({hit_rate:.1f} % hit rate), " \
+               f"{len(self.key_to_sim)} parameter sets cached"
+
+
+class StreamedObjective(object):
+    """
+    sums up the squared errors of a candidate's treatment results as they arrive, sqrt(sum / n) with n being
+    the number of observations the candidate can be compared to is a lower bound of the candidate's RMSE
+    """
+
+    def __init__(self, trt_no_to_observations, threshold, n, sq_sum=0.0):
+        self.trt_no_to_observations = trt_no_to_observations
+        self.threshold = threshold
+        self.n = n
+        self.sq_sum = sq_sum
+        self.trt_no_to_sim = {}
 
-    asyncio.run(send_receive())
+    def lower_bound(self):
+        return np.sqrt(self.sq_sum / self.n) if self.n > 0 else 0.0
+
+    def add(self, trt_no, sim_values):
+        "add the simulated values of a treatment, true if the candidate can't get below the threshold anymore"
+        if trt_no in self.trt_no_to_sim:
+            return False
+        self.trt_no_to_sim[trt_no] = sim_values
+        diffs = np.asarray(self.trt_no_to_observations.get(trt_no, []), dtype=np.float64) \
+            - np.asarray(sim_values, dtype=np.float64)
+        self.sq_sum += float(np.nansum(diffs * diffs))
+        return self.lower_bound() > self.threshold
 
 
 class SpotpySetup(object):
     def __init__(self, user_params, observations, observations_order, observation_treatment_nos,
-                 prod_writer_sr, cons_reader_sr, path_to_out):
+                 prod_writer_sr, cons_reader_sr, path_to_out, path_to_eval_cache=None,
+                 fidelity_trt_nos=None, promotion_factor=1.0, abort_factor=0.0, channel_host=None):
         self.user_params = user_params
         self.params = []
         self.observations = observations
         self.observations_order = observations_order
         self.observation_treatment_nos = observation_treatment_nos
         self.prod_writer_queue = SimpleQueue()
-        self.cons_reader_queue = SimpleQueue()
         self.path_to_out_file = path_to_out + "/spot_setup.out"
+        # candidate number -> future of the result, the results are matched by the candidate attribute
+        self.pending = {}
+        # candidate number -> the objective accumulated from the streamed treatment results
+        self.streams = {}
+        self.pending_lock = threading.Lock()
+        self.round_no = 0
+        self.candidate_nos = itertools.count()
+        self.param_names_sent = False
+        # held while spotpy code runs in a BatchForEach, released while waiting for MONICA
+        self.lock = threading.Lock()
+        self.local = threading.local()
         self.capnp_thread = Thread(target=start_thread, args=(prod_writer_sr, self.prod_writer_queue,
-                                                              cons_reader_sr, self.cons_reader_queue))
+                                                              cons_reader_sr, self.on_result, channel_host))
         self.capnp_thread.start()
 
         if not os.path.exists(path_to_out):
@@ -80,50 +299,228 @@ class SpotpySetup(object):
             if "derive_function" not in par:  # spotpy does not care about derived params
                 self.params.append(spotpy.parameter.Uniform(**par)) ##Is this where I set the distribution?
 
+        # the sampled values are snapped to the parameter's step, so near identical candidates are evaluated once
+        self.name_to_grid = {par["name"]: (par.get("low", None), par.get("step", None), par.get("high", None))
+                             for par in user_params if "derive_function" not in par}
+        self.eval_context = {
+            "params": sorted([name, *grid] for name, grid in self.name_to_grid.items()),
+            "treatments": sorted(observation_treatment_nos),
+            "outputs": observations_order
+        }
+
+        # multi-fidelity: candidates are simulated on the treatment subset first and only on the remaining
+        # treatments if the subset's RMSE is at most promotion_factor times the best full RMSE so far
+        self.fidelity_trt_nos = sorted(set(fidelity_trt_nos or []) & set(observation_treatment_nos))
+        self.remaining_trt_nos = sorted(set(observation_treatment_nos) - set(self.fidelity_trt_nos))
+        self.promotion_factor = promotion_factor
+        self.best_rmse = None
+        self.fidelity_stats = {"candidates": 0, "promoted": 0, "treatment_runs": 0}
+
+        # candidates are aborted as soon as their RMSE can't get below abort_factor times the best RMSE anymore
+        self.abort_factor = abort_factor
+        self.aborted = 0
+        self.sim_vector = calibration_objective.SimVector(observation_treatment_nos, observations_order)
+        self.trt_no_to_observations = {trt_no: self.observations[i * len(observations_order):
+                                                                 (i + 1) * len(observations_order)]
+                                       for i, trt_no in enumerate(sorted(observation_treatment_nos))}
+        if not (self.fidelity_trt_nos and self.remaining_trt_nos):
+            self.fidelity_trt_nos = []
+
+        self.eval_cache = EvaluationCache(path_to_eval_cache, self.eval_context) if path_to_eval_cache else None
+
     def parameters(self):
         return spotpy.parameter.generate(self.params)
 
+    def next_round(self):
+        "start a new round, e.g. the burn-in or a complex evolution loop"
+        self.round_no += 1
+
+    def on_result(self, candidate, content, trt_no=None):
+        if trt_no is not None:
+            self.on_treatment_result(candidate, content, trt_no)
+            return
+        with self.pending_lock:
+            future = self.pending.pop(candidate, None)
+            self.streams.pop(candidate, None)
+        if future:
+            future.set_result(content)
+        else:
+            print(f"received result for unknown candidate: {candidate}", flush=True)
+
+    def on_treatment_result(self, candidate, content, trt_no):
+        "a streamed treatment result, aborts the candidate if it has become hopeless"
+        with self.pending_lock:
+            stream = self.streams.get(candidate, None)
+        if stream is None:
+            return
+        received = json.loads(content) if isinstance(content, str) else content
+        if not stream.add(trt_no, self.sim_vector.values(received) if isinstance(received, dict) else received):
+            return
+        with self.pending_lock:
+            future = self.pending.pop(candidate, None)
+            self.streams.pop(candidate, None)
+        if future:
+            # skip the candidate's jobs the producer has not sent yet
+            self.prod_writer_queue.put(fbp_capnp.IP.new_message(attributes=[{"key": "cancel",
+                                                                             "value": candidate}]))
+            print(f"aborted candidate: {candidate} (rmse >= {stream.lower_bound():g}, "
+                  f"threshold: {stream.threshold:g})", flush=True)
+            future.set_result(stream)
+
+    def rebuild_eval_cache(self, path_to_results_csv):
+        "add the evaluations of a previous run's results csv to the evaluation cache, returns the number added"
+        if not self.eval_cache:
+            self.eval_cache = EvaluationCache(None, self.eval_context)
+        return self.eval_cache.add_results_csv(path_to_results_csv, self.name_to_grid)
+
+    def wait_for(self, future):
+        if getattr(self.local, "batched", False):
+            # let the other candidates of the batch run while waiting
+            self.lock.release()
+            try:
+                return future.result()
+            finally:
+                self.lock.acquire()
+        return future.result()
+
     def simulation(self, params):
-        msg_content = dict(zip(params.name, params))
-        out_ip = fbp_capnp.IP.new_message(content=json.dumps(msg_content))
-        self.prod_writer_queue.put(out_ip)
-        with open(self.path_to_out_file, "a") as _:
-            _.write(f"{datetime.now()} sent params to monica setup: {params}\n")
-        print("sent params to monica setup:", params, flush=True)
+        msg_content = {name: calibration_params.quantize(float(val), *self.name_to_grid.get(name, ()))
+                       for name, val in zip(params.name, params)}
+        if not self.eval_cache:
+            return self.evaluate(msg_content)[0]
+
+        key = EvaluationCache.key(msg_content)
+        cached = self.eval_cache.lookup(key)
+        if isinstance(cached, Future):
+            cached = self.wait_for(cached)
+        if cached is not None:
+            print("cached results for params:", msg_content, flush=True)
+            return list(cached)
+        try:
+            sim_list, complete = self.evaluate(msg_content)
+        except Exception as e:
+            self.eval_cache.discard(key, e)
+            raise e
+        # the results of aborted or not promoted candidates depend on the best results of this run
+        self.eval_cache.put(key, sim_list, complete)
+        return sim_list
 
-        in_ip = self.cons_reader_queue.get()
+    def evaluate(self, msg_content):
+        """
+        evaluate the parameters on all treatments or, in multi-fidelity mode, on the subset first,
+        returns the sim_list and if it is complete (not aborted or not promoted)
+        """
+        if not self.fidelity_trt_nos:
+            sim_list, complete = self.simulate_remote(msg_content)
+            return self.track_best(sim_list), complete
 
-        s: str = in_ip.content.as_text()
-        trt_no_to_output_name_to_result = json.loads(s)
+        self.fidelity_stats["candidates"] += 1
+        self.fidelity_stats["treatment_runs"] += len(self.fidelity_trt_nos)
+        sim_list, subset_complete = self.simulate_remote(msg_content, self.fidelity_trt_nos)
+        partial_rmse = spotpy.objectivefunctions.rmse(self.observations, sim_list)
+        if self.best_rmse is not None and not np.isnan(partial_rmse) \
+                and partial_rmse > self.promotion_factor * self.best_rmse:
+            # the unsimulated treatments stay NaN, so the objective is the subset's RMSE
+            print(f"not promoted (partial rmse: {partial_rmse:g} best: {self.best_rmse:g}):", msg_content,
+                  flush=True)
+            return sim_list, False
 
-        #with open(self.path_to_out_file, "a") as _:
-        #    _.write(f"{datetime.now()} jsons loaded cal-sp-set-M\n")
-        print("received monica results:", trt_no_to_output_name_to_result, flush=True)
-
-        # remove all simulation results which are not in the observed list
-        sim_list = []
-        for trt_no in sorted(self.observation_treatment_nos):
-            output_name_to_result = trt_no_to_output_name_to_result.get(str(trt_no), None)
-            for output_name in self.observations_order:
-                if output_name_to_result is None:
-                    sim_list.append(np.nan)
-                    continue
-                if output_name == "HIAM":
-                    gwam = output_name_to_result.get("GWAM", None)
-                    cwam = output_name_to_result.get("CWAM", None)
-                    if gwam is not None and cwam is not None:
-                        sim_list.append(gwam / cwam * 100.0)
-                    else:
-                        sim_list.append(np.nan)
-                else:
-                    v = output_name_to_result.get(output_name, None)
-                    if v is None:
-                        sim_list.append(np.nan)
-                    else:
-                        if output_name in ["Z31D", "ADAT", "MDAT"]:
-                            sim_list.append(int(datetime.fromisoformat(v).timetuple().tm_yday))
-                        else:
-                            sim_list.append(v)
+        self.fidelity_stats["promoted"] += 1
+        self.fidelity_stats["treatment_runs"] += len(self.remaining_trt_nos)
+        remaining_sim_list, complete = self.simulate_remote(msg_content, self.remaining_trt_nos,
+                                                            known_sim_list=sim_list)
+        sim_list = [sim if trt_no in self.fidelity_trt_nos else remaining_sim
+                    for trt_no, sim, remaining_sim in zip(self.sim_list_trt_nos(), sim_list, remaining_sim_list)]
+        return self.track_best(sim_list), subset_complete and complete
+
+    def track_best(self, sim_list):
+        "remember the best RMSE of the candidates evaluated on all treatments"
+        rmse = spotpy.objectivefunctions.rmse(self.observations, sim_list)
+        if not np.isnan(rmse) and (self.best_rmse is None or rmse < self.best_rmse):
+            self.best_rmse = rmse
+        return sim_list
+
+    def stream_objective(self, trt_nos, known_sim_list=None):
+        "the objective to accumulate the streamed results of the treatments with, None if there is nothing to abort"
+        if self.abort_factor <= 0 or self.best_rmse is None:
+            return None
+        obs = np.asarray(self.observations, dtype=np.float64)
+        in_scope = np.isin(self.sim_list_trt_nos(), trt_nos)
+        sq_sum = 0.0
+        if known_sim_list is not None:
+            # e.g. the results of the multi-fidelity subset
+            diffs = obs - np.asarray(known_sim_list, dtype=np.float64)
+            sq_sum = float(np.nansum(diffs * diffs))
+            in_scope |= ~np.isnan(diffs)
+        n = int(np.count_nonzero(in_scope & ~np.isnan(obs)))
+        return StreamedObjective(self.trt_no_to_observations, self.abort_factor * self.best_rmse, n, sq_sum)
+
+    def format_abort_stats(self):
+        return f"early abort (factor: {self.abort_factor}): {self.aborted} evaluations aborted"
+
+    def sim_list_trt_nos(self):
+        "the treatment number of each sim_list entry"
+        return [trt_no for trt_no in sorted(self.observation_treatment_nos) for _ in self.observations_order]
+
+    def format_fidelity_stats(self):
+        fs = self.fidelity_stats
+        full_runs = fs["candidates"] * len(self.observation_treatment_nos)
+        saved = (1.0 - fs["treatment_runs"] / full_runs) * 100.0 if full_runs > 0 else 0.0
+        return f"multi-fidelity (subset: {self.fidelity_trt_nos} promotion factor: {self.promotion_factor}): " \
+               f"{fs['promoted']}/{fs['candidates']} candidates promoted, " \
+               f"{fs['treatment_runs']}/{full_runs} MONICA runs ({saved:.1f} % saved)"
+
+    def simulate_remote(self, msg_content, trt_nos=None, known_sim_list=None):
+        """
+        evaluate the parameters by MONICA (on all or the given treatments, the others are NaN),
+        an aborted candidate gets just the results streamed until the abort, returns the sim_list and
+        if the candidate has not been aborted
+        """
+        candidate = str(next(self.candidate_nos))
+        future = Future()
+        stream = self.stream_objective(trt_nos if trt_nos is not None else self.observation_treatment_nos,
+                                       known_sim_list)
+        attributes = [{"key": "round", "value": str(self.round_no)}, {"key": "candidate", "value": candidate},
+                      {"key": "content_type", "value": "ParamSet"}]
+        if trt_nos is not None:
+            attributes.append({"key": "trt_nos", "value": json.dumps(trt_nos)})
+        with self.pending_lock:
+            self.pending[candidate] = future
+            if stream:
+                self.streams[candidate] = stream
+            # the names are sent just with the first parameter set, the others have the same names (in order)
+            param_set = calibration_capnp.ParamSet.new_message(
+                names=[] if self.param_names_sent else list(msg_content.keys()),
+                values=[float(v) for v in msg_content.values()])
+            self.param_names_sent = True
+            self.prod_writer_queue.put(fbp_capnp.IP.new_message(content=param_set, attributes=attributes))
+        with open(self.path_to_out_file, "a") as _:
+            _.write(f"{datetime.now()} sent params to monica setup (round: {self.round_no} candidate: {candidate}): "
+                    f"{msg_content}\n")
+        print(f"sent params to monica setup (round: {self.round_no} candidate: {candidate}):", msg_content, flush=True)
+
+        result = self.wait_for(future)
+        aborted = isinstance(result, StreamedObjective)
+        if aborted:
+            self.aborted += 1
+            # like candidates evaluated on a treatment subset, the objective is the RMSE of the treatments
+            # simulated so far, which is above the lower bound that caused the abort
+            sim_list = []
+            for trt_no in self.sim_vector.trt_nos:
+                sim_values = result.trt_no_to_sim.get(trt_no, None)
+                sim_list.extend(sim_values if sim_values is not None else [np.nan] * len(self.observations_order))
+        else:
+            received = json.loads(result) if isinstance(result, str) else result
+
+            #with open(self.path_to_out_file, "a") as _:
+            #    _.write(f"{datetime.now()} jsons loaded cal-sp-set-M\n")
+            print("received monica results:", received, flush=True)
+            if isinstance(received, dict):
+                # the consumer has not been given the observations' matching, so it sent all the results
+                # remove all simulation results which are not in the observed list
+                sim_list = self.sim_vector.vector(received).tolist()
+            else:
+                sim_list = received
 
         #with open(self.path_to_out_file, "a") as _:
         #    _.write(f"{datetime.now()} simulation and observation matchedcal-sp-set-M\n\n")
@@ -134,7 +531,7 @@ class SpotpySetup(object):
             _.write(f"sim_list: {sim_list}\n")
             #_.write(f"obs_list: {self.observations}\n")
         # besides the order the length of observation results and simulation results should be the same
-        return sim_list
+        return sim_list, not aborted
 
     def evaluation(self):
         return self.observations
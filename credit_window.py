@@ -0,0 +1,93 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import asyncio
+import time
+import zmq
+
+
+class CreditWindow:
+    """
+    bounds the number of jobs in flight between producer and consumer,
+    the consumer credits back one slot (or the number in the credit message) for each result it received
+    and for each job it gave up on (lost by MONICA)
+    """
+
+    def __init__(self, context=None, credit_address=None, max_in_flight=0):
+        self.max_in_flight = max_in_flight
+        self.socket = None
+        if credit_address:
+            self.socket = context.socket(zmq.PULL)
+            self.socket.bind(credit_address)
+        elif max_in_flight > 0:
+            raise ValueError("A bounded in-flight window needs a credit_address to receive the credits from!")
+        # the concurrently sending candidates take their slots one after the other
+        self.lock = asyncio.Lock()
+        self.in_flight = 0
+        self.sent = 0
+        self.credited = 0
+        self.blocked_secs = 0.0
+        self.start_time = time.perf_counter()
+
+    def _credit(self, msg):
+        credits = int(msg) if msg else 1
+        self.credited += credits
+        self.in_flight = max(0, self.in_flight - credits)
+
+    async def acquire(self):
+        "wait until there is a free slot in the window"
+        if not self.socket:
+            return
+        # collect the credits which are already there
+        while await self.socket.poll(0, zmq.POLLIN):
+            self._credit(await self.socket.recv())
+        if 0 < self.max_in_flight <= self.in_flight:
+            start = time.perf_counter()
+            while self.in_flight >= self.max_in_flight:
+                self._credit(await self.socket.recv())
+            self.blocked_secs += time.perf_counter() - start
+
+    async def send(self, socket, data):
+        "send data on the (zmq.asyncio) socket as soon as the window allows it"
+        async with self.lock:
+            await self.acquire()
+            self.in_flight += 1
+            start = time.perf_counter()
+            await socket.send(data)
+            self.blocked_secs += time.perf_counter() - start
+            self.sent += 1
+
+    def metrics(self):
+        secs = time.perf_counter() - self.start_time
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "sent": self.sent,
+            "credited": self.credited,
+            "send_rate": self.sent / secs if secs > 0 else 0.0,
+            "blocked_secs": self.blocked_secs
+        }
+
+    def format_metrics(self):
+        m = self.metrics()
+        window = m["max_in_flight"] if m["max_in_flight"] > 0 else "unbounded"
+        return f"in flight: {m['in_flight']}/{window} sent: {m['sent']} credited: {m['credited']} " \
+               f"send rate: {m['send_rate']:.1f} jobs/s blocked: {m['blocked_secs']:.3f} s"
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
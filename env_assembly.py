@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+from collections import namedtuple
+import json
+import time
+import tracemalloc
+
+from env_serializer import Raw
+
+# on the same date fertilization worksteps come before irrigation worksteps
+FERTILIZATION = 0
+IRRIGATION = 1
+
+EventRecord = namedtuple("EventRecord", ["date", "kind", "json"])
+
+
+def create_event_records(trt_no_to_fertilizers, trt_no_to_irrigation):
+    """
+    create the date sorted, immutable event records per treatment from the date -> workstep maps,
+    each workstep is json encoded exactly once and shared by all envs of the treatment
+    """
+    trt_no_to_records = {}
+    for kind, trt_no_to_date_to_ws in [(FERTILIZATION, trt_no_to_fertilizers), (IRRIGATION, trt_no_to_irrigation)]:
+        for trt_no, date_to_ws in trt_no_to_date_to_ws.items():
+            records = trt_no_to_records.setdefault(trt_no, [])
+            for date, ws in date_to_ws.items():
+                records.append(EventRecord(date, kind, Raw(json.dumps(ws))))
+    return {trt_no: tuple(sorted(records, key=lambda r: (r.date, r.kind)))
+            for trt_no, records in trt_no_to_records.items()}
+
+
+def encode_event_records(records):
+    "encode the event records as the inner part of a json array (without brackets)"
+    return Raw(", ".join(r.json for r in records))
+
+
+def assemble_worksteps(sowing_json, static_ws_jsons, events_json, harvest_json):
+    "assemble the worksteps json array in one pass from already encoded parts"
+    parts = [sowing_json]
+    parts.extend(static_ws_jsons)
+    if events_json:
+        parts.append(events_json)
+    parts.append(harvest_json)
+    return Raw("[" + ", ".join(parts) + "]")
+
+
+class AssemblyStats:
+    "time and (optionally) peak allocated memory needed to assemble the env of each treatment"
+
+    def __init__(self, trace_allocations=False):
+        self.trace_allocations = trace_allocations
+        if trace_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.stats = []
+        self._start_time = None
+        self._start_mem = 0
+
+    def start(self):
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+            self._start_mem = tracemalloc.get_traced_memory()[0]
+        self._start_time = time.perf_counter()
+
+    def stop(self, trt_no, no_of_events, env_size):
+        secs = time.perf_counter() - self._start_time
+        peak_alloc = tracemalloc.get_traced_memory()[1] - self._start_mem if self.trace_allocations else None
+        s = {"trt_no": trt_no, "events": no_of_events, "bytes": env_size, "secs": secs, "peak_alloc": peak_alloc}
+        self.stats.append(s)
+        return s
+
+    @staticmethod
+    def format(s):
+        alloc = f", {s['peak_alloc'] / 1024:.1f} KiB peak alloc" if s["peak_alloc"] is not None else ""
+        return f"trt_no: {s['trt_no']} events: {s['events']} env: {s['bytes'] / 1024:.1f} KiB " \
+               f"assembled in {s['secs'] * 1000:.3f} ms{alloc}"
+
+    def summary(self):
+        if len(self.stats) == 0:
+            return "no envs assembled"
+        secs = sum(s["secs"] for s in self.stats)
+        allocs = [s["peak_alloc"] for s in self.stats if s["peak_alloc"] is not None]
+        alloc = f", max {max(allocs) / 1024:.1f} KiB peak alloc" if allocs else ""
+        return f"{len(self.stats)} envs assembled in {secs * 1000:.3f} ms " \
+               f"({secs * 1000 / len(self.stats):.3f} ms/env){alloc}"
+
+    def clear(self):
+        self.stats.clear()
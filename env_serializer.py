@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import json
+import sys
+import time
+
+
+class Raw(str):
+    "an already json encoded value, which will be spliced into the output as is"
+    pass
+
+
+def _with_slot_marker(obj, path, marker):
+    "return a copy of obj (copying only the containers along path) with the value at path replaced by marker"
+    if len(path) == 0:
+        return marker
+    key = path[0]
+    if isinstance(obj, dict):
+        copy = dict(obj)
+        copy[key] = _with_slot_marker(obj.get(key, None), path[1:], marker)
+    elif isinstance(obj, list):
+        copy = list(obj)
+        copy[key] = _with_slot_marker(obj[key], path[1:], marker)
+    else:
+        raise ValueError(f"Can't create slot at path element {key!r} of a {type(obj).__name__}!")
+    return copy
+
+
+def _value_at(obj, path):
+    for key in path:
+        if isinstance(obj, dict):
+            if key not in obj:
+                return None
+        obj = obj[key]
+    return obj
+
+
+class JsonTemplate:
+    """
+    json encoding of obj, where the invariant parts are encoded once and only the values
+    at the slot paths are encoded on each call to encode
+    the result is byte identical to json.dumps(obj) (with the slot values set) using the default separators
+    """
+
+    def __init__(self, obj, slots):
+        "slots: slot name -> path (tuple of dict keys and list indices), missing dict keys will be appended"
+        self.slot_names = list(slots.keys())
+        markers = {}
+        marked = obj
+        for i, (name, path) in enumerate(slots.items()):
+            marker = f"@@json-template-slot-{i}-{id(self)}@@"
+            markers[json.dumps(marker)] = name
+            marked = _with_slot_marker(marked, tuple(path), marker)
+        s = json.dumps(marked)
+
+        positions = []
+        for marker_json, name in markers.items():
+            pos = s.find(marker_json)
+            if pos < 0 or s.find(marker_json, pos + 1) >= 0:
+                raise ValueError(f"Slot {name!r} could not be uniquely placed in the template!")
+            positions.append((pos, len(marker_json), name))
+        positions.sort()
+
+        # parts alternate between fixed fragments and slot placeholders
+        self._parts = []
+        self._slot_indices = []
+        start = 0
+        for pos, length, name in positions:
+            self._parts.append(s[start:pos])
+            self._slot_indices.append((len(self._parts), name))
+            self._parts.append(None)
+            start = pos + length
+        self._parts.append(s[start:])
+
+        # the current values in obj are used if a slot value isn't supplied
+        self._defaults = {}
+        for name, path in slots.items():
+            val = _value_at(obj, path)
+            self._defaults[name] = json.dumps(val)
+
+    def encode(self, values):
+        "encode the template with the given slot values (plain values or Raw json strings)"
+        parts = list(self._parts)
+        for index, name in self._slot_indices:
+            if name in values:
+                v = values[name]
+                parts[index] = v if isinstance(v, Raw) else json.dumps(v)
+            else:
+                parts[index] = self._defaults[name]
+        return "".join(parts)
+
+    def encode_bytes(self, values):
+        "like encode, but returns the utf-8 bytes which zmq's send_json would send"
+        return self.encode(values).encode("utf8")
+
+
+def encode_list(raw_items):
+    "encode a json array from already encoded items"
+    return Raw("[" + ", ".join(raw_items) + "]")
+
+
+def run_benchmark(path_to_env_json, no_of_envs=2000):
+    "compare envs/sec of json.dumps of the whole env against the json template"
+    with open(path_to_env_json) as _:
+        env = json.load(_)
+
+    worksteps = env["cropRotation"][0]["worksteps"]
+    env_tmpl = JsonTemplate(env, {
+        "SoilProfileParameters": ("params", "siteParameters", "SoilProfileParameters"),
+        "HeightNN": ("params", "siteParameters", "HeightNN"),
+        "Latitude": ("params", "siteParameters", "Latitude"),
+        "worksteps": ("cropRotation", 0, "worksteps"),
+        "pathToClimateCSV": ("pathToClimateCSV",),
+        "customId": ("customId",),
+    })
+    sowing_tmpl = JsonTemplate(worksteps[0], {"date": ("date",), "PlantDensity": ("PlantDensity",)})
+    harvest_tmpl = JsonTemplate(worksteps[-1], {"latest-date": ("latest-date",)})
+    event_jsons = [json.dumps(ws) for ws in worksteps[1:-1]]
+
+    start = time.perf_counter()
+    for i in range(no_of_envs):
+        env["customId"]["trt_no"] = i
+        before = json.dumps(env).encode("utf8")
+    before_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(no_of_envs):
+        custom_id = dict(env["customId"], trt_no=i)
+        ws_jsons = [sowing_tmpl.encode({"date": worksteps[0]["date"]})]
+        ws_jsons.extend(event_jsons)
+        ws_jsons.append(harvest_tmpl.encode({}))
+        after = env_tmpl.encode_bytes({
+            "SoilProfileParameters": env["params"]["siteParameters"]["SoilProfileParameters"],
+            "HeightNN": env["params"]["siteParameters"]["HeightNN"],
+            "Latitude": env["params"]["siteParameters"]["Latitude"],
+            "worksteps": encode_list(ws_jsons),
+            "customId": custom_id,
+        })
+    after_secs = time.perf_counter() - start
+
+    print(f"env size: {len(before)} bytes, worksteps: {len(worksteps)}, byte identical: {before == after}")
+    print(f"json.dumps(env):      {no_of_envs / before_secs:10.1f} envs/sec")
+    print(f"JsonTemplate.encode:  {no_of_envs / after_secs:10.1f} envs/sec")
+
+
+if __name__ == "__main__":
+    run_benchmark(sys.argv[1] if len(sys.argv) > 1 else "out/env_template_trt_no-12_iter_count-19478.json")
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import csv
+import hashlib
+import os
+import pickle
+import re
+
+import numpy as np
+
+CACHE_DIR_NAME = "__tablecache__"
+CACHE_FORMAT_VERSION = 2
+SNIFF_PREFIX_SIZE = 8192
+# the ids are looked up as they are written, they must not become floats (or dates)
+INT_ID_COLUMNS = frozenset(["TRTNO"])
+STR_ID_COLUMNS = frozenset(["SOIL_ID", "SOIL_NAME", "WST_ID"])
+
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def sniff_dialect(file, delimiters=";,\t", prefix_size=SNIFF_PREFIX_SIZE):
+    "determine the csv dialect from a small prefix of the file and rewind the file"
+    prefix = file.read(prefix_size)
+    file.seek(0)
+    # cut the prefix at the last complete line, so the sniffer doesn't see a partial row
+    last_nl = prefix.rfind("\n")
+    if 0 < last_nl < len(prefix) - 1:
+        prefix = prefix[:last_nl + 1]
+    return csv.Sniffer().sniff(prefix, delimiters=delimiters)
+
+
+def _typed_id_column(name, values):
+    "the ids of INT_ID_COLUMNS as int64 if all are ints, all others (or if any is missing) as strings"
+    if name in INT_ID_COLUMNS:
+        try:
+            return np.array([int(v) for v in values], dtype=np.int64)
+        except ValueError:
+            pass
+    return np.array(values, dtype=object)
+
+
+def _typed_column(values):
+    "convert a column of strings to a typed numpy array (int64, float64, datetime64[D] or object)"
+    non_empty = [v for v in values if v != ""]
+    if len(non_empty) == 0:
+        return np.full(len(values), np.nan)
+    try:
+        ints = [int(v) for v in non_empty]
+        if len(ints) == len(values):
+            return np.array(ints, dtype=np.int64)
+    except ValueError:
+        pass
+    try:
+        return np.array([float(v) if v != "" else np.nan for v in values], dtype=np.float64)
+    except ValueError:
+        pass
+    if all(_DATE_RE.fullmatch(v) for v in non_empty):
+        return np.array([v if v != "" else "NaT" for v in values], dtype="datetime64[D]")
+    return np.array(values, dtype=object)
+
+
+class ExperimentTable:
+    "columnar representation of an AgMIP experiment table (e.g. Fertilizers.csv, Meta.csv)"
+
+    def __init__(self, names, skipped_lines, raw, columns):
+        self.names = names
+        self.skipped_lines = skipped_lines
+        self.raw = raw  # column name -> list of the original strings
+        self.columns = columns  # column name -> typed numpy array
+        self._indices = {}
+
+    def __len__(self):
+        return len(self.raw[self.names[0]]) if len(self.names) > 0 else 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_indices"] = {}
+        return state
+
+    def index(self, key="TRTNO"):
+        "key value -> numpy array of the row indices having this key value (in file order)"
+        if key not in self._indices:
+            key_to_rows = {}
+            for i, k in enumerate(self.columns[key].tolist()):
+                key_to_rows.setdefault(k, []).append(i)
+            self._indices[key] = {k: np.array(rows, dtype=np.int64) for k, rows in key_to_rows.items()}
+        return self._indices[key]
+
+    def raw_row(self, i):
+        "the i-th row as column name -> original string"
+        return {name: self.raw[name][i] for name in self.names}
+
+
+def parse_table(file, skip_lines=1):
+    "parse the csv file in a single pass into an ExperimentTable, the header is the line after skip_lines"
+    dialect = sniff_dialect(file)
+    reader = csv.reader(file, dialect)
+    skipped_lines = [next(reader) for _ in range(skip_lines)]
+    names = next(reader)
+    rows = [row for row in reader if len(row) > 0]
+    no_of_cols = len(names)
+    rows = [row if len(row) == no_of_cols else (row + [""] * no_of_cols)[:no_of_cols] for row in rows]
+    cols = list(zip(*rows)) if len(rows) > 0 else [()] * no_of_cols
+    raw = {name: list(col) for name, col in zip(names, cols)}
+    columns = {name: _typed_id_column(name, col) if name in INT_ID_COLUMNS | STR_ID_COLUMNS else _typed_column(col)
+               for name, col in raw.items()}
+    return ExperimentTable(names, skipped_lines, raw, columns)
+
+
+def _cache_path(path, skip_lines, cache_dir):
+    abs_path = os.path.abspath(path)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(abs_path), CACHE_DIR_NAME)
+    key = hashlib.sha1(f"{abs_path}|{skip_lines}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{key}.pickle")
+
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as _:
+        for chunk in iter(lambda: _.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_table(path, skip_lines=1, use_cache=True, cache_dir=None):
+    """
+    load the experiment table at path,
+    parsed tables are cached in process and on disk (in a __tablecache__ dir next to the file),
+    keyed by the file's mtime and (if the mtime changed) the hash of its content
+    """
+    if not hasattr(load_table, "cache"):
+        load_table.cache = {}
+
+    stat = os.stat(path)
+    mem_key = (os.path.abspath(path), skip_lines)
+    if use_cache and mem_key in load_table.cache:
+        mtime_ns, size, table = load_table.cache[mem_key]
+        if mtime_ns == stat.st_mtime_ns and size == stat.st_size:
+            return table
+
+    path_to_cache = _cache_path(path, skip_lines, cache_dir)
+    sha1 = None
+    table = None
+    write_cache = use_cache
+    if use_cache and os.path.exists(path_to_cache):
+        try:
+            with open(path_to_cache, "rb") as _:
+                entry = pickle.load(_)
+            if entry["version"] == CACHE_FORMAT_VERSION:
+                if entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                    table = entry["table"]
+                    write_cache = False
+                else:
+                    # just touched files keep their cached table, but the cache entry gets the new mtime
+                    sha1 = _file_sha1(path)
+                    if sha1 == entry["sha1"]:
+                        table = entry["table"]
+        except Exception as e:
+            print(f"{os.path.basename(__file__)} ignoring unreadable table cache {path_to_cache}: {e}")
+
+    if table is None:
+        with open(path, newline="") as _:
+            table = parse_table(_, skip_lines=skip_lines)
+
+    if write_cache:
+        try:
+            os.makedirs(os.path.dirname(path_to_cache), exist_ok=True)
+            tmp_path = f"{path_to_cache}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as _:
+                pickle.dump({
+                    "version": CACHE_FORMAT_VERSION,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "sha1": sha1 if sha1 else _file_sha1(path),
+                    "table": table
+                }, _, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path_to_cache)
+        except OSError as e:
+            print(f"{os.path.basename(__file__)} couldn't write table cache {path_to_cache}: {e}")
+
+    if use_cache:
+        load_table.cache[mem_key] = (stat.st_mtime_ns, stat.st_size, table)
+    return table
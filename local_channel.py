@@ -0,0 +1,241 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+# In-process fbp channels
+# -----------------------
+# a pure Python replacement of the channel binary for local runs, the channels are hosted in a thread
+# with its own event loop and are served (by sturdy refs) to other processes like the channel binary does,
+# code running in the host's thread can read and write the channels directly without going through RPC
+
+import asyncio
+import os
+import subprocess as sp
+import sys
+import threading
+import time
+import uuid
+
+import capnp
+import pysodium
+
+import common
+
+fbp_capnp = capnp.load("capnp_schemas/fbp.capnp", imports=[])
+
+
+class Channel:
+    "a bounded buffer of fbp channel messages (Channel.Msg) between the writers and readers"
+
+    def __init__(self, buffer_size=1):
+        self.buffer = asyncio.Queue(maxsize=max(1, buffer_size))
+
+    async def write(self, msg):
+        await self.buffer.put(msg)
+
+    async def write_value(self, value):
+        await self.buffer.put(fbp_capnp.Channel.Msg.new_message(value=value))
+
+    async def read(self):
+        return await self.buffer.get()
+
+
+class Reader(fbp_capnp.Channel.Reader.Server):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def read_context(self, context):  # read @0 () -> Msg;
+        msg = await self.channel.read()
+        if msg.which() == "done":
+            context.results.done = None
+        else:
+            context.results.value = msg.value
+
+    async def close_context(self, context):  # close @1 ();
+        pass
+
+
+class Writer(fbp_capnp.Channel.Writer.Server):
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def write_context(self, context):  # write @0 Msg;
+        # the message has to outlive the call
+        await self.channel.write(context.params.as_builder())
+
+    async def close_context(self, context):  # close @1 ();
+        pass
+
+
+class ChannelRestorer(common.persistence_capnp.Restorer.Server):
+    "restores the hosted readers and writers from their sturdy ref tokens"
+
+    def __init__(self):
+        self.sr_token_to_cap = {}
+
+    async def restore_context(self, context):  # restore @0 RestoreParams -> (cap :Capability);
+        context.results.cap = self.sr_token_to_cap.get(context.params.localRef.text, None)
+
+
+class ChannelHost:
+    "hosts channels in a thread with its own (kj enabled) event loop and serves them to other processes"
+
+    def __init__(self, host="localhost", port=0):
+        self.host = host
+        self.port = port
+        self.vat_sign_pk, _ = pysodium.crypto_sign_keypair()
+        self.restorer = None
+        self.loop = None
+        self.sr_to_channel = {}
+        self._started = threading.Event()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        if self._error:
+            raise self._error
+
+    def _run(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            self._error = e
+            self._started.set()
+
+    async def _serve(self):
+        async with capnp.kj_loop():
+            self.loop = asyncio.get_running_loop()
+            self.restorer = ChannelRestorer()
+
+            async def on_connection(stream):
+                await capnp.TwoPartyServer(stream, bootstrap=self.restorer).on_disconnect()
+
+            server = await capnp.AsyncIoStream.create_server(on_connection, self.host, self.port)
+            self.port = server.sockets[0].getsockname()[1]
+            self._started.set()
+            async with server:
+                await server.serve_forever()
+
+    def run(self, coro):
+        "run the coroutine on the host's event loop, returns a concurrent.futures.Future"
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def create_channel(self, name=None, buffer_size=1):
+        "create a channel, returns the sturdy refs of its reader and writer (like the channel binary prints them)"
+        async def create():
+            channel = Channel(buffer_size)
+            srs = {}
+            for kind, cap in [("reader_sr", Reader(channel)), ("writer_sr", Writer(channel))]:
+                sr_token = f"{name or 'chan'}_{kind[:-3]}_{uuid.uuid4()}"
+                self.restorer.sr_token_to_cap[sr_token] = cap
+                srs[kind] = common.sturdy_ref_str(self.vat_sign_pk, self.host, self.port, sr_token)
+                self.sr_to_channel[srs[kind]] = channel
+            return {"channel": channel, **srs}
+
+        return self.run(create()).result()
+
+    def channel(self, sturdy_ref):
+        "the hosted channel of the reader or writer sturdy ref, None if it is not hosted here"
+        return self.sr_to_channel.get(sturdy_ref, None)
+
+
+async def echo(reader_sr, writer_sr):
+    "copy the values of one channel to another until done, e.g. to measure round trips"
+    con_man = common.ConnectionManager()
+    reader = await con_man.try_connect(reader_sr, cast_as=fbp_capnp.Channel.Reader, retry_secs=1)
+    writer = await con_man.try_connect(writer_sr, cast_as=fbp_capnp.Channel.Writer, retry_secs=1)
+    while True:
+        msg = await reader.read()
+        if msg.which() == "done":
+            await writer.write(done=None)
+            break
+        await writer.write(value=msg.value.as_struct(fbp_capnp.IP))
+
+
+def benchmark(path_to_channel=None, no_of_round_trips=1000):
+    """
+    measure the round trip latency (setup -> channel -> echo process -> channel -> setup) for the in-process
+    channels or, with path_to_channel, the channel binary
+    """
+    import importlib
+    run_calibration = importlib.import_module("run-calibration")
+    procs = []
+    start = time.perf_counter()
+    host = ChannelHost()
+    if path_to_channel:
+        out_chan = run_calibration.get_reader_writer_srs_from_channel(path_to_channel, "bench_out")
+        in_chan = run_calibration.get_reader_writer_srs_from_channel(path_to_channel, "bench_in")
+        procs += [out_chan["chan"], in_chan["chan"]]
+    else:
+        out_chan = host.create_channel("bench_out")
+        in_chan = host.create_channel("bench_in")
+    startup_secs = time.perf_counter() - start
+    procs.append(sp.Popen([sys.executable, os.path.abspath(__file__), "echo", out_chan["reader_sr"], in_chan["writer_sr"]]))
+
+    async def round_trips():
+        out_local = host.channel(out_chan["writer_sr"])
+        in_local = host.channel(in_chan["reader_sr"])
+        if out_local and in_local:
+            write, read = out_local.write_value, in_local.read
+        else:
+            con_man = common.ConnectionManager()
+            writer = await con_man.try_connect(out_chan["writer_sr"], cast_as=fbp_capnp.Channel.Writer, retry_secs=1)
+            reader = await con_man.try_connect(in_chan["reader_sr"], cast_as=fbp_capnp.Channel.Reader, retry_secs=1)
+            write, read = (lambda value: writer.write(value=value)), reader.read
+        ip = fbp_capnp.IP.new_message(content="x" * 200, attributes=[{"key": "candidate", "value": "0"}])
+        await write(ip)  # warm up, the echo process has to connect first
+        await read()
+        times = []
+        for _ in range(no_of_round_trips):
+            t = time.perf_counter()
+            await write(ip)
+            await read()
+            times.append(time.perf_counter() - t)
+        if out_local:
+            await out_local.write(fbp_capnp.Channel.Msg.new_message(done=None))
+        else:
+            await writer.write(done=None)
+        return sorted(times)
+
+    times = host.run(round_trips()).result()
+    procs.pop().wait(timeout=10)  # the echo process
+    for proc in procs:
+        proc.terminate()
+    mode = "channel binary" if path_to_channel else "in-process channels"
+    print(f"{mode}: startup: {startup_secs * 1000:.1f} ms, round trip median: {times[len(times) // 2] * 1e6:.0f} us "
+          f"p90: {times[int(len(times) * 0.9)] * 1e6:.0f} us (n={len(times)})")
+
+
+def serve_like_channel_binary(argv):
+    "host a single channel and print its sturdy refs like 'channel --name=NAME --output_srs' does"
+    name = next((arg.split("=", 1)[1] for arg in argv if arg.startswith("--name=")), None)
+    srs = ChannelHost().create_channel(name)
+    print(f"readerSR={srs['reader_sr']}", flush=True)
+    print(f"writerSR={srs['writer_sr']}", flush=True)
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "echo":
+        asyncio.run(capnp.run(echo(sys.argv[2], sys.argv[3])))
+    elif "--output_srs" in sys.argv:
+        serve_like_channel_binary(sys.argv[1:])
+    else:
+        config = {"path_to_channel": None, "round_trips": "1000"}
+        common.update_config(config, sys.argv, print_config=True)
+        benchmark(config["path_to_channel"], int(config["round_trips"]))
@@ -12,12 +12,16 @@
 # Landscape Systems Analysis at the ZALF.
 # Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
 
+from datetime import date, timedelta
+import hashlib
 import os
 import json
+import pickle
 
 import soil_io3
 
 CACHE_REFS = False
+ENV_SNAPSHOT_FORMAT_VERSION = 1
 
 OP_AVG = 0
 OP_MEDIAN = 1
@@ -142,41 +146,143 @@ def write_output_header_rows(output_ids,
     return out
 
 
-def write_output(output_ids, values, round_ids={}):
-    "write actual output lines"
-    out = []
+def output_column_plan(output_ids, round_ids={}):
+    """
+    the columns of the outputs as list of (name, digits to round to or None, width), width is the number of
+    csv columns of an output (the layers of a not aggregated range, else 1), computed once per output ids
+    """
+    if not hasattr(output_column_plan, "cache"):
+        output_column_plan.cache = {}
+
+    key = (tuple((oid["name"], oid["displayName"], oid["fromLayer"], oid["toLayer"], oid.get("organ", None),
+                  oid.get("layerAggOp", None)) for oid in output_ids),
+           tuple(sorted(round_ids.items())))
+    plan = output_column_plan.cache.get(key, None)
+    if plan is None:
+        plan = []
+        for oid in output_ids:
+            oid_name = oid["displayName"] if len(oid["displayName"]) > 0 else oid["name"]
+            width = oid["toLayer"] - oid["fromLayer"] + 1 \
+                if not oid_is_organ(oid) and oid_is_range(oid) and oid["layerAggOp"] == OP_NONE else 1
+            plan.append((oid_name, round_ids.get(oid_name, None), width))
+        output_column_plan.cache[key] = plan
+    return plan
+
+
+def _plan_row(plan, row_values):
+    row = []
+    for (_, ndigits, _), j__ in zip(plan, row_values):
+        if isinstance(j__, list):
+            if ndigits is None:
+                row.extend(j__)
+            else:
+                row.extend(round(jv_, ndigits) for jv_ in j__)
+        else:
+            row.append(j__ if ndigits is None else round(j__, ndigits))
+    return row
+
+
+def iter_output(output_ids, values, round_ids={}):
+    "the output rows one by one, values are the outputs' columns (values[i][k] = output i of row k)"
+    plan = output_column_plan(output_ids, round_ids)
     if len(values) > 0:
         for k in range(0, len(values[0])):
-            i = 0
-            row = []
-            for oid in output_ids:
-                oid_name = oid["displayName"] if len(oid["displayName"]) > 0 else oid["name"]
-                j__ = values[i][k]
-                if isinstance(j__, list):
-                    for jv_ in j__:
-                        row.append(round(jv_, round_ids[oid_name]) if oid_name in round_ids else jv_)
-                else:
-                    row.append(round(j__, round_ids[oid_name]) if oid_name in round_ids else j__)
-                i += 1
-            out.append(row)
-    return out
+            yield _plan_row(plan, [column[k] for column in values])
+
+
+def iter_output_obj(output_ids, values, round_ids={}):
+    "the output rows one by one, values are the rows as objects (name -> value)"
+    plan = output_column_plan(output_ids, round_ids)
+    for obj in values:
+        yield _plan_row(plan, [obj.get(name, "") for name, _, _ in plan])
+
+
+def write_output(output_ids, values, round_ids={}):
+    "write actual output lines"
+    return list(iter_output(output_ids, values, round_ids))
 
 
 def write_output_obj(output_ids, values, round_ids={}):
     "write actual output lines"
-    out = []
-    for obj in values:
-        row = []
-        for oid in output_ids:
-            oid_name = oid["displayName"] if len(oid["displayName"]) > 0 else oid["name"]
-            j__ = obj.get(oid_name, "")
-            if isinstance(j__, list):
-                for jv_ in j__:
-                    row.append(round(jv_, round_ids[oid_name]) if oid_name in round_ids else jv_)
-            else:
-                row.append(round(j__, round_ids[oid_name]) if oid_name in round_ids else j__)
-        out.append(row)
-    return out
+    return list(iter_output_obj(output_ids, values, round_ids))
+
+
+def results_are_objs(results):
+    "are the results rows as objects ('obj-outputs?' true) or the columns of the outputs (false)"
+    return len(results) > 0 and isinstance(results[0], dict)
+
+
+def iter_output_rows(output_ids, results, round_ids={}):
+    "the output rows one by one of both layouts of the results (see results_are_objs)"
+    if results_are_objs(results):
+        return iter_output_obj(output_ids, results, round_ids)
+    return iter_output(output_ids, results, round_ids)
+
+
+def output_columns(output_ids, results):
+    "the results of both layouts as output name -> column (list of the output's values per row)"
+    names = [name for name, _, _ in output_column_plan(output_ids)]
+    if results_are_objs(results):
+        return {name: [obj.get(name, None) for obj in results] for name in names or results[0].keys()}
+    return dict(zip(names, results))
+
+
+def first_row(output_ids, results):
+    "the first row of the results of both layouts as output name -> value, {} if there are no results"
+    if results_are_objs(results):
+        return results[0]
+    return {name: column[0] for name, column in output_columns(output_ids, results).items() if len(column) > 0}
+
+
+def output_block(output_ids, values, round_ids={}, obj=True, start=0, stop=None):
+    """
+    the rows start to stop of the outputs as numpy (float64) array, outputs which are lists get their plan's
+    width of columns, missing and non numeric values (e.g. dates) are NaN
+    """
+    import numpy as np
+
+    plan = output_column_plan(output_ids, round_ids)
+    no_of_rows = len(values) if obj else (len(values[0]) if len(values) > 0 else 0)
+    stop = no_of_rows if stop is None else min(stop, no_of_rows)
+    start = min(start, stop)
+    block = np.full((stop - start, sum(width for _, _, width in plan)), np.nan)
+    col = 0
+    for i, (name, ndigits, width) in enumerate(plan):
+        column = [obj_.get(name, None) for obj_ in values[start:stop]] if obj else values[i][start:stop]
+        if width == 1:
+            try:
+                block[:, col] = np.asarray(column, dtype=np.float64)
+            except (TypeError, ValueError):
+                block[:, col] = [v if isinstance(v, (int, float)) else np.nan for v in column]
+        else:
+            try:
+                block[:, col:col + width] = np.asarray(column, dtype=np.float64).reshape(-1, width)
+            except (TypeError, ValueError):
+                # lists of other lengths or missing values
+                for r, v in enumerate(column):
+                    if isinstance(v, list):
+                        v = v[:width]
+                        block[r, col:col + len(v)] = v
+        if ndigits is not None:
+            block[:, col:col + width] = np.round(block[:, col:col + width], ndigits)
+        col += width
+    return block
+
+
+def write_output_blocks(file, output_ids, values, round_ids={}, obj=True, block_rows=1024, delimiter=";"):
+    """
+    write the numeric outputs (see output_block) as csv rows with numpy, block_rows at a time,
+    so the memory needed doesn't depend on the number of rows, NaN is written as empty value
+    """
+    import numpy as np
+
+    no_of_rows = len(values) if obj else (len(values[0]) if len(values) > 0 else 0)
+    for start in range(0, no_of_rows, block_rows):
+        block = output_block(output_ids, values, round_ids, obj, start, start + block_rows)
+        lines = []
+        for row in block.tolist():
+            lines.append(delimiter.join("" if v != v else repr(v) for v in row))
+        file.write("\n".join(lines) + "\n")
 
 
 def is_absolute_path(p):
@@ -233,6 +339,28 @@ def read_and_parse_json_file(path):
             "success": False}
 
 
+def read_and_parse_json_file_cached(path):
+    """
+    read and parse the json file once per process, the cache is keyed by the normalized absolute path
+    and validated by the file's modification time (and size), the result is shared between all callers
+    and must not be modified (find_and_replace_references copies it)
+    """
+    if not hasattr(read_and_parse_json_file_cached, "cache"):
+        read_and_parse_json_file_cached.cache = {}
+
+    key = os.path.normcase(os.path.abspath(path))
+    stat = os.stat(key)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = read_and_parse_json_file_cached.cache.get(key, None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    res = read_and_parse_json_file(key)
+    if res["success"]:
+        read_and_parse_json_file_cached.cache[key] = (version, res)
+    return res
+
+
 def parse_json_string(jsonString):
     return {"result": json.loads(jsonString), "errors": [], "success": True}
 
@@ -242,75 +370,78 @@ def is_string_type(j):
 
 
 def find_and_replace_references(root, j):
-    sp = supported_patterns()
-
-    success = True
+    """
+    resolve the references (supported_patterns) in j, the result shares the subtrees without references
+    with j, the results of the reference functions are copied (they may be shared, e.g. cached includes)
+    """
     errors = []
+    result = _resolve_references(root, j, supported_patterns(), errors)
+    return {"result": result, "errors": errors, "success": len(errors) == 0}
 
-    if isinstance(j, list) and len(j) > 0:
-
-        arr = []
-        array_is_reference_function = False
-
-        if is_string_type(j[0]):
-            if j[0] in sp:
-                f = sp[j[0]]
-                array_is_reference_function = True
-
-                #check for nested function invocations in the arguments
-                funcArr = []
-                for i in j:
-                    res = find_and_replace_references(root, i)
-                    success = success and res["success"]
-                    if not res["success"]:
-                        for err in res["errors"]:
-                            errors.append(err)
-                    funcArr.append(res["result"])
-
-                #invoke function
-                jaes = f(root, funcArr)
-
-                success = success and jaes["success"]
-                if not jaes["success"]:
-                    for err in jaes["errors"]:
-                        errors.append(err)
-
-                #if successful try to recurse into result for functions in result
-                if jaes["success"]:
-                    res = find_and_replace_references(root, jaes["result"])
-                    success = success and res["success"]
-                    if not res["success"]:
-                        for err in res["errors"]:
-                            errors.append(err)
-                    return {"result": res["result"], "errors": errors, "success": len(errors) == 0}
-                else:
-                    return {"result": {}, "errors": errors, "success": len(errors) == 0}
 
-        if not array_is_reference_function:
-            for jv in j:
-                res = find_and_replace_references(root, jv)
-                success = success and res["success"]
-                if not res["success"]:
-                    for err in res["errors"]:
-                        errors.append(err)
-                arr.append(res["result"])
+def _resolve_references(root, j, patterns, errors):
+    "walk j with an explicit stack, copy just the nodes with changed children (or all if owned)"
+
+    def new_frame(node, owned):
+        # [node, children, (key, child) being resolved, copy of node (None = unchanged), owned, reference function]
+        f = None
+        if isinstance(node, list):
+            if len(node) > 0 and is_string_type(node[0]):
+                f = patterns.get(node[0], None)
+            return [node, enumerate(node), None, list(node) if owned else None, owned, f]
+        return [node, iter(node.items()), None, dict(node) if owned else None, owned, f]
+
+    if not isinstance(j, (list, dict)) or len(j) == 0:
+        return j
 
-        return {"result": arr, "errors": errors, "success": len(errors) == 0}
+    stack = [new_frame(j, False)]
+    while True:
+        frame = stack[-1]
+        item = next(frame[1], None)
+        if item is not None:
+            key, child = item
+            if isinstance(child, (list, dict)):
+                if len(child) > 0:
+                    frame[2] = item
+                    stack.append(new_frame(child, frame[4]))
+                elif frame[4]:
+                    frame[3][key] = type(child)()
+            continue
 
-    elif isinstance(j, dict):
-        obj = {}
+        node, _, _, copy, owned, f = stack.pop()
+        value = node if copy is None else copy
+        if f is not None:
+            # the (resolved) arguments are complete, invoke the function and resolve its result
+            res = f(root, value)
+            if res["success"]:
+                value = res["result"]
+                if isinstance(value, (list, dict)):
+                    if len(value) > 0:
+                        stack.append(new_frame(value, True))
+                        continue
+                    value = type(value)()
+            else:
+                errors.extend(res["errors"])
+                value = {}
 
-        for k, v in j.items():
-            r = find_and_replace_references(root, v)
-            success = success and r["success"]
-            if not r["success"]:
-                for e in r["errors"]:
-                    errors.append(e)
-            obj[k] = r["result"]
+        if len(stack) == 0:
+            return value
 
-        return {"result": obj, "errors": errors, "success": len(errors) == 0}
+        parent = stack[-1]
+        key, child = parent[2]
+        if value is not child:
+            if parent[3] is None:
+                parent[3] = list(parent[0]) if isinstance(parent[0], list) else dict(parent[0])
+            parent[3][key] = value
 
-    return {"result": j, "errors": errors, "success": len(errors) == 0}
+
+def _copy_tree(j):
+    "copy the dicts and lists of the json tree, so that none of its subtrees is shared with another tree (or itself)"
+    if isinstance(j, dict):
+        return {k: _copy_tree(v) for k, v in j.items()}
+    if isinstance(j, list):
+        return [_copy_tree(v) for v in j]
+    return j
 
 
 def supported_patterns():
@@ -488,13 +619,8 @@ def supported_patterns():
         "include from file"
         if len(j__) == 2 and is_string_type(j__[1]):
 
-            base_path = default_value(root, "include-file-base-path", ".")
-            path_to_file = j__[1]
-            if not is_absolute_path(path_to_file):
-                path_to_file = base_path + "/" + path_to_file
-            path_to_file = replace_env_vars(path_to_file)
-            path_to_file = fix_system_separator(path_to_file)
-            jo_ = read_and_parse_json_file(path_to_file)
+            path_to_file = include_file_path(root, j__[1])
+            jo_ = read_and_parse_json_file_cached(path_to_file)
             if jo_["success"] and not isinstance(jo_["result"], type(None)):
                 return {"result": jo_["result"], "errors": [], "success": True}
 
@@ -575,6 +701,35 @@ def supported_patterns():
     return supported_patterns.m
 
 
+def include_file_path(root, path_to_file):
+    "the path of a file included by include-from-file"
+    if not is_absolute_path(path_to_file):
+        path_to_file = default_value(root, "include-file-base-path", ".") + "/" + path_to_file
+    path_to_file = replace_env_vars(path_to_file)
+    return fix_system_separator(path_to_file)
+
+
+def included_files(root, j):
+    "the normalized absolute paths of the files j includes (include-from-file), also the ones included by them"
+    paths = set()
+    stack = [j]
+    while len(stack) > 0:
+        node = stack.pop()
+        if isinstance(node, dict):
+            stack.extend(node.values())
+        elif isinstance(node, list):
+            if len(node) == 2 and node[0] == "include-from-file" and is_string_type(node[1]):
+                path_to_file = os.path.normcase(os.path.abspath(include_file_path(root, node[1])))
+                if path_to_file not in paths:
+                    paths.add(path_to_file)
+                    res = read_and_parse_json_file_cached(path_to_file)
+                    if res["success"]:
+                        stack.append(res["result"])
+            else:
+                stack.extend(node)
+    return paths
+
+
 def print_possible_errors(errs, include_warnings=False):
     if not errs["success"]:
         for err in errs["errors"]:
@@ -622,6 +777,9 @@ def create_env_json_from_json_config(crop_site_sim):
     cropj = crop_site_sim2["crop"]
     sitej = crop_site_sim2["site"]
     simj = crop_site_sim2["sim"]
+    # the csv options get the latitude below, the resolved simj may share them with the sim.json
+    simj = dict(simj)
+    simj["climate.csv-options"] = dict(simj["climate.csv-options"])
 
     env = {}
     env["type"] = "Env"
@@ -651,6 +809,10 @@ def create_env_json_from_json_config(crop_site_sim):
     env["csvViaHeaderOptions"] = simj["climate.csv-options"]
     env["csvViaHeaderOptions"]["latitude"] = sitej["SiteParameters"]["Latitude"]
 
+    # the resolved nodes may be shared with the config files, the cached include files and references,
+    # the env is changed by its users (e.g. the calibration parameters), so it gets its own tree
+    env = _copy_tree(env)
+
     climate_csv_string = crop_site_sim["climate"] if "climate" in crop_site_sim else ""
     if climate_csv_string:
         add_climate_data_to_env(env, simj, climate_csv_string)
@@ -658,14 +820,201 @@ def create_env_json_from_json_config(crop_site_sim):
     return env
 
 
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as _:
+        for chunk in iter(lambda: _.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def create_env_json_from_json_config_cached(crop_site_sim, snapshot_dir):
+    """
+    create_env_json_from_json_config, but load the env from a snapshot (pickle) in snapshot_dir if it has been
+    created from the same crop/site/sim(/climate) json and the included files haven't changed since
+    (same mtime and size or else same content), otherwise create the env and store the snapshot
+    """
+    if any(j is None for j in crop_site_sim.values()):
+        return None
+
+    key = hashlib.sha1(json.dumps(crop_site_sim, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    path_to_snapshot = os.path.join(snapshot_dir, f"env.{key}.pickle")
+    if os.path.exists(path_to_snapshot):
+        try:
+            with open(path_to_snapshot, "rb") as _:
+                entry = pickle.load(_)
+            if entry["version"] == ENV_SNAPSHOT_FORMAT_VERSION:
+                for path_to_file, (mtime_ns, size, sha1) in entry["includes"].items():
+                    stat = os.stat(path_to_file)
+                    if (stat.st_mtime_ns != mtime_ns or stat.st_size != size) and _file_sha1(path_to_file) != sha1:
+                        break
+                else:
+                    return entry["env"]
+        except Exception as e:
+            print(f"{os.path.basename(__file__)} ignoring unusable env snapshot {path_to_snapshot}: {e}")
+
+    env = create_env_json_from_json_config(crop_site_sim)
+    if env is None:
+        return None
+
+    try:
+        includes = {}
+        for k, j in crop_site_sim.items():
+            if k != "climate":
+                for path_to_file in included_files(j, j):
+                    stat = os.stat(path_to_file)
+                    includes[path_to_file] = (stat.st_mtime_ns, stat.st_size, _file_sha1(path_to_file))
+        os.makedirs(snapshot_dir, exist_ok=True)
+        tmp_path = f"{path_to_snapshot}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as _:
+            pickle.dump({
+                "version": ENV_SNAPSHOT_FORMAT_VERSION,
+                "includes": includes,
+                "env": env
+            }, _, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path_to_snapshot)
+    except OSError as e:
+        print(f"{os.path.basename(__file__)} couldn't write env snapshot {path_to_snapshot}: {e}")
+    return env
+
+
+# ids of the climate elements (MONICA's ACD enum), used as keys in the climateData of an env
+ACD_NAME_TO_ID = {
+    "day": 0,
+    "month": 1,
+    "year": 2,
+    "tmin": 3,
+    "tavg": 4,
+    "tmax": 5,
+    "precip": 6,
+    "globrad": 7,
+    "wind": 8,
+    "sunhours": 9,
+    "cloudamount": 10,
+    "relhumid": 11,
+    "airpress": 12,
+    "vaporpress": 13,
+    "co2": 14,
+    "o3": 15,
+    "et0": 16,
+    "dewpointTemp": 17,
+}
+DATE_ACD_NAMES = ["iso-date", "de-date", "day", "month", "year"]
+
+
+def _header_to_acd_conversion(header_to_acd_names):
+    "header -> (acd name, conversion function), the acd name can be given as [name, '*' or '+', value]"
+    h2c = {}
+    for header, acd in header_to_acd_names.items():
+        if isinstance(acd, list) and len(acd) == 3:
+            name, op, v = acd
+            if op == "*":
+                h2c[header] = (name, lambda x, v=v: x * v)
+            elif op == "+":
+                h2c[header] = (name, lambda x, v=v: x + v)
+            else:
+                h2c[header] = (name, None)
+        else:
+            h2c[header] = (acd, None)
+    return h2c
+
+
+def read_climate_data_from_csv_string(climate_csv_string, csv_options):
+    """
+    read a climate csv string (as described by the climate.csv-options of sim.json) into the
+    json representation of MONICA's climate DataAccessor (as expected in env["climateData"])
+    """
+    sep = csv_options.get("csv-separator", ",")
+    no_of_header_lines = int(csv_options.get("no-of-climate-file-header-lines", 2))
+    h2c = _header_to_acd_conversion(csv_options.get("header-to-acd-names", {}))
+    start_date = csv_options.get("start-date", "")
+    end_date = csv_options.get("end-date", "")
+
+    lines = climate_csv_string.splitlines()
+    if len(lines) < no_of_header_lines:
+        raise ValueError("Climate csv has less lines than the configured number of header lines!")
+    headers = [h.strip() for h in lines[0].split(sep)]
+
+    date_cols = {}
+    value_cols = []
+    for i, h in enumerate(headers):
+        acd_name, conv = h2c.get(h, (h, None))
+        if acd_name in DATE_ACD_NAMES:
+            date_cols[acd_name] = i
+        elif acd_name in ACD_NAME_TO_ID:
+            value_cols.append((i, ACD_NAME_TO_ID[acd_name], conv))
+    if "iso-date" not in date_cols and "de-date" not in date_cols \
+            and not all(n in date_cols for n in ["day", "month", "year"]):
+        raise ValueError("Climate csv has no iso-date, de-date or day, month and year columns!")
+
+    acd_to_values = {acd: [] for _, acd, _2 in value_cols}
+    dates = []
+    for line in lines[no_of_header_lines:]:
+        if len(line.strip()) == 0:
+            continue
+        cols = line.split(sep)
+        if "iso-date" in date_cols:
+            d = date.fromisoformat(cols[date_cols["iso-date"]].strip())
+        elif "de-date" in date_cols:
+            day, month, year = cols[date_cols["de-date"]].strip().split(".")
+            d = date(int(year), int(month), int(day))
+        else:
+            d = date(int(cols[date_cols["year"]]), int(cols[date_cols["month"]]), int(cols[date_cols["day"]]))
+        iso_date = d.isoformat()
+        if (start_date and iso_date < start_date) or (end_date and iso_date > end_date):
+            continue
+        if len(dates) > 0 and d != dates[-1] + timedelta(days=1):
+            raise ValueError(f"Climate csv is not continuous, {dates[-1].isoformat()} is followed by {iso_date}!")
+        dates.append(d)
+        for i, acd, conv in value_cols:
+            v = float(cols[i])
+            acd_to_values[acd].append(conv(v) if conv else v)
+
+    if len(dates) == 0:
+        raise ValueError("Climate csv contains no data (in the configured date range)!")
+
+    # MONICA needs the average temperature
+    tavg = ACD_NAME_TO_ID["tavg"]
+    tmin = ACD_NAME_TO_ID["tmin"]
+    tmax = ACD_NAME_TO_ID["tmax"]
+    if tavg not in acd_to_values and tmin in acd_to_values and tmax in acd_to_values:
+        acd_to_values[tavg] = [(mi + ma) / 2.0 for mi, ma in zip(acd_to_values[tmin], acd_to_values[tmax])]
+
+    return {
+        "type": "DataAccessor",
+        "data": {str(acd): vals for acd, vals in sorted(acd_to_values.items())},
+        "startDate": dates[0].isoformat(),
+        "endDate": dates[-1].isoformat(),
+        "fromStep": 0,
+        "numberOfSteps": len(dates)
+    }
+
+
+def read_climate_data_json_cached(path_to_climate_csv, csv_options):
+    """
+    read and json encode the climate data of the csv file once per path and options,
+    the returned string can be embedded as env["climateData"]
+    """
+    if not hasattr(read_climate_data_json_cached, "cache"):
+        read_climate_data_json_cached.cache = {}
+
+    key = (path_to_climate_csv, json.dumps(csv_options, sort_keys=True))
+    if key not in read_climate_data_json_cached.cache:
+        with open(path_to_climate_csv) as _:
+            climate_data = read_climate_data_from_csv_string(_.read(), csv_options)
+        read_climate_data_json_cached.cache[key] = json.dumps(climate_data)
+    return read_climate_data_json_cached.cache[key]
+
+
 def add_climate_data_to_env(env, simj, climate_csv_string=""):
     "add climate data separately to env"
 
-    #if not climate_csv_string:
-    #    with open(simj["climate.csv"]) as _:
-    #        climate_csv_string = _.read()
+    if not climate_csv_string:
+        with open(simj["climate.csv"]) as _:
+            climate_csv_string = _.read()
 
-    #if climate_csv_string:
-    #    env["climateData"] = json.loads(monica_python.readClimateDataFromCSVStringViaHeadersToJsonString(climate_csv_string, json.dumps(simj["climate.csv-options"])))
+    if climate_csv_string:
+        env["climateData"] = read_climate_data_from_csv_string(climate_csv_string, simj["climate.csv-options"])
+        env["pathToClimateCSV"] = ""
 
     return env
@@ -22,32 +22,26 @@ from scipy.interpolate import NearestNDInterpolator
 from pyproj import Transformer
 from datetime import date, timedelta
 
+import experiment_tables
+
 
 def read_csv(path_to_setups_csv, key="id", skip_lines=0, empty_value=""):
     """read sim setup from csv file"""
-    with open(path_to_setups_csv) as _:
-        key_to_data = {}
-        # determine seperator char
-        dialect = csv.Sniffer().sniff(_.read(), delimiters=';,\t')
-        _.seek(0)
-        # read csv with seperator char
-        reader = csv.reader(_, dialect)
-        for _ in range(skip_lines):
-            next(reader)
-        header_cols = next(reader)
-        for row in reader:
-            data = {}
-            for i, header_col in enumerate(header_cols):
-                value = row[i]
-                if value.lower() in ["true", "false"]:
-                    value = value.lower() == "true"
-                if header_col == key:
-                    value = int(value)
-                if value == "":
-                    value = empty_value
-                data[header_col] = value
-            key_to_data[int(data[key])] = data
-        return key_to_data
+    table = experiment_tables.load_table(path_to_setups_csv, skip_lines=skip_lines)
+    key_to_data = {}
+    for i in range(len(table)):
+        data = {}
+        for header_col in table.names:
+            value = table.raw[header_col][i]
+            if value.lower() in ["true", "false"]:
+                value = value.lower() == "true"
+            if header_col == key:
+                value = int(value)
+            if value == "":
+                value = empty_value
+            data[header_col] = value
+        key_to_data[int(data[key])] = data
+    return key_to_data
 
 
 def read_sim_setups(path_to_setups_csv):
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import hashlib
+import json
+import sqlite3
+import time
+
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# evicting makes room for this fraction of max_bytes at once
+EVICT_TO_FRACTION = 0.9
+
+
+def env_key(env_bytes):
+    """
+    hash of the json encoded env (as encoded by the env's JsonTemplate with customId set to None),
+    note that climate data referenced by pathToClimateCSV is part of the key by path only
+    """
+    if isinstance(env_bytes, str):
+        env_bytes = env_bytes.encode("utf-8")
+    return hashlib.sha256(env_bytes).hexdigest()
+
+
+def encode_result(msg):
+    "json encode a MONICA result message without its customId for the cache"
+    return json.dumps({k: v for k, v in msg.items() if k != "customId"}).encode("utf-8")
+
+
+def decode_result(result_bytes, custom_id):
+    "a cached result message with the given customId"
+    msg = json.loads(result_bytes)
+    msg["customId"] = custom_id
+    return msg
+
+
+class ResultCache:
+    "MONICA results by env key, stored in a SQLite file, least recently used results are evicted beyond max_bytes"
+
+    def __init__(self, path_to_db, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path_to_db, timeout=30, isolation_level=None)
+        # producer and consumers access the cache concurrently
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS results "
+                          "(key TEXT PRIMARY KEY, result BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        # the running total of the stored bytes is kept in the file, as producer and consumers put results
+        self.conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                          "bytes INTEGER NOT NULL)")
+        self.conn.execute("INSERT OR IGNORE INTO totals (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM results")
+        self.total_bytes = self.conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+
+    def get(self, key):
+        "the cached result bytes or None"
+        row = self.conn.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.conn.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, result_bytes):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO results (key, result, size, last_used) VALUES (?, ?, ?, ?)",
+                              (key, result_bytes, len(result_bytes), time.time()))
+            self.conn.execute("UPDATE totals SET bytes = bytes + ? WHERE id = 0",
+                              (len(result_bytes) - (row[0] if row else 0),))
+            self.total_bytes = self.conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.stored += 1
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        # delete the least recently used results which don't fit into EVICT_TO_FRACTION * max_bytes anymore
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            cur = self.conn.execute("DELETE FROM results WHERE key IN ("
+                                    "SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) "
+                                    "AS total FROM results) WHERE total > ?)",
+                                    (int(self.max_bytes * EVICT_TO_FRACTION),))
+            self.conn.execute("UPDATE totals SET bytes = (SELECT COALESCE(SUM(size), 0) FROM results) WHERE id = 0")
+            self.total_bytes = self.conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.evicted += max(0, cur.rowcount)
+
+    def size(self):
+        "number of cached results and their size in bytes"
+        count, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return count, size
+
+    def format_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100.0 if lookups > 0 else 0.0
+        return f"result cache hits: {self.hits} misses: {self.misses} ({hit_rate:.1f} % hit rate) " \
+               f"stored: {self.stored} evicted: {self.evicted}"
+
+    def reset_stats(self):
+        self.hits = self.misses = self.stored = self.evicted = 0
+
+    def close(self):
+        self.conn.close()
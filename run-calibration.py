@@ -2,7 +2,6 @@ import asyncio
 from datetime import datetime
 import capnp
 from collections import defaultdict
-import csv
 import json
 import matplotlib.pyplot as plt
 import numpy as np
@@ -13,8 +12,12 @@ import sys
 import time
 import uuid
 
+import calibration_objective
+import calibration_params
+import calibration_results
 import calibration_spotpy_setup_MONICA
 import common
+import local_channel
 import monica_run_lib
 
 fbp_capnp = capnp.load("capnp_schemas/fbp.capnp", imports=[])
@@ -59,10 +62,30 @@ async def run_calibration(server=None, prod_port=None, cons_port=None):
         #"/home/rpm/start_manual_test_services/GitHub/mas-infrastructure/src/cpp/common/_cmake_release/channel",
         "path_to_channel": "C:/MONICA/monica_win64_3.6.21/bin/channel" if local_run else
         "/home/rpm/start_manual_test_services/GitHub/mas-infrastructure/src/cpp/common/_cmake_release/channel",
+        "local_channels": local_run,  # host the two channels in this process instead of running the channel binary
         "path_to_python": "python" if local_run else "/home/rpm/.conda/envs/clim4cast/bin/python",
         "repetitions": "10000",
         #"treatments": "[1,2,3,4,5]",
         "treatments": "[6,7,8,9,10,11,12,13]",
+        "params_csv": "data/calibratethese_step2.csv",
+        "max_in_flight": "0",  # > 0 = bound the jobs in flight between producer and consumer
+        "credit_port": "6699",
+        "result_cache": None,  # path to a result cache (sqlite) file shared by producer and consumer
+        "cache_port": "6698",
+        "resubmit_port": "6697",
+        "announce_port": "6696",
+        "job_timeout": "300",  # secs to wait for the result of a sent job before it is resubmitted
+        "eval_cache": "eval_cache.jsonl",  # file (in path_to_out) caching the results per parameter set, "" = off
+        "parallel_candidates": "1",  # > 1 = number of parameter sets evaluated by MONICA at the same time
+        "resume": False,  # continue from the last checkpoint and the results of the previous (aborted) run
+        "random_state": "",  # seed of the sampler, a resumed run without checkpoint replays its evaluations
+        "warm_start": "",  # results csv of a previous run, its best parameter sets seed the initial population
+        "warm_start_rows": "10",
+        "cold_start_results": "",  # results csv of a cold start on the same treatments to compare convergence with
+        "fidelity_treatments": "",  # e.g. "[6,10]" = simulate the candidates on these treatments first
+        "promotion_factor": "1.2",  # ... and on all if the subset's RMSE is <= factor * best RMSE so far
+        "abort_factor": "0",  # > 0 = abort a candidate as soon as its RMSE will be > factor * best RMSE so far
+        "obj_outputs": "",  # "false" = MONICA sends the outputs as columns instead of objects (see run-producer.py)
     }
 
     common.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -79,16 +102,68 @@ async def run_calibration(server=None, prod_port=None, cons_port=None):
     with open(path_to_out_file, "a") as _:
         _.write(f"{datetime.now()} config: {config}\n")
 
+    measurements = monica_run_lib.read_csv("data/measurements.csv", key="TRTNO",
+                                           skip_lines=1, empty_value=np.nan)
+    #observations_order = ["GWAM","CWAA","CWAM","CNAM","GNAM","HIAM","GWGM"] ##I NEED TO CHANCE THIS FOR THE STEP" CALIBRATION##
+    #observations_order = ["Z31D", "ADAT", "MDAT"]
+    observations_order = ["GWAM"]
+    observation_treatment_nos = []
+    observations = []
+    for trt_no in sorted(measurements.keys()):
+        if len(treatments) > 0 and trt_no not in treatments:
+            continue
+        observation_treatment_nos.append(trt_no)
+        trt = measurements[trt_no]
+        for output_name in observations_order:
+            v = trt[output_name]
+            if v is np.nan:
+                observations.append(np.nan)
+                continue
+            if output_name in calibration_objective.DOY_OUTPUT_NAMES:
+                observations.append(int(datetime.fromisoformat(v).timetuple().tm_yday))
+            else:
+                observations.append(float(v))
+
     procs = []
 
-    prod_chan_data = get_reader_writer_srs_from_channel(config["path_to_channel"], "prod_chan")
-    procs.append(prod_chan_data["chan"])
-    cons_chan_data = get_reader_writer_srs_from_channel(config["path_to_channel"], "cons_chan")
-    procs.append(cons_chan_data["chan"])
+    channel_host = None
+    if config["local_channels"]:
+        channel_host = local_channel.ChannelHost()
+        prod_chan_data = channel_host.create_channel("prod_chan")
+        cons_chan_data = channel_host.create_channel("cons_chan")
+    else:
+        prod_chan_data = get_reader_writer_srs_from_channel(config["path_to_channel"], "prod_chan")
+        procs.append(prod_chan_data["chan"])
+        cons_chan_data = get_reader_writer_srs_from_channel(config["path_to_channel"], "cons_chan")
+        procs.append(cons_chan_data["chan"])
 
     #with open(path_to_out_folder + "/spot_setup.out", "a") as _:
     #    _.write(f"{datetime.now()} Process procs.append(sp.Popen(.()producer\n")
 
+    window_args = {
+        "producer": [f"resubmit_address=tcp://*:{config['resubmit_port']}",
+                     f"announce_address=tcp://*:{config['announce_port']}"],
+        "consumer": [f"resubmit_address=tcp://localhost:{config['resubmit_port']}",
+                     f"announce_address=tcp://localhost:{config['announce_port']}",
+                     f"job_timeout={config['job_timeout']}"]
+    }
+    if int(config["max_in_flight"]) > 0:
+        window_args["producer"] += [f"max_in_flight={config['max_in_flight']}",
+                                    f"credit_address=tcp://*:{config['credit_port']}"]
+        window_args["consumer"] += [f"credit_address=tcp://localhost:{config['credit_port']}"]
+    # the consumer matches the results against the observations and sends just the simulated vector
+    sim_vector = calibration_objective.SimVector(observation_treatment_nos, observations_order)
+    window_args["consumer"] += [f"sim_vector={json.dumps(sim_vector.spec())}"]
+    if float(config["abort_factor"]) > 0:
+        window_args["consumer"] += ["stream_results=true"]
+    if config["obj_outputs"] != "":
+        window_args["producer"] += [f"obj_outputs={str(config['obj_outputs']).lower()}"]
+    if config["result_cache"]:
+        window_args["producer"] += [f"result_cache={config['result_cache']}",
+                                    f"cache_address=tcp://*:{config['cache_port']}"]
+        window_args["consumer"] += [f"result_cache={config['result_cache']}",
+                                    f"cache_address=tcp://localhost:{config['cache_port']}"]
+
     procs.append(sp.Popen([
         config["path_to_python"],
         "run-producer.py",
@@ -100,7 +175,8 @@ async def run_calibration(server=None, prod_port=None, cons_port=None):
         f"reader_sr={prod_chan_data['reader_sr']}",
         f"path_to_out={config['path_to_out']}",
         f"treatments={config['treatments']}",
-    ]))
+        f"params_csv={config['params_csv']}",
+    ] + window_args["producer"]))
 
     #with open(path_to_out_folder + "/spot_setup.out", "a") as _:
     #    _.write(f"{datetime.now()} Process procs.append(sp.Popen(.()consumer\n")
@@ -113,60 +189,50 @@ async def run_calibration(server=None, prod_port=None, cons_port=None):
         f"port={config['cons-port']}",
         f"writer_sr={cons_chan_data['writer_sr']}",
         f"path_to_out={config['path_to_out']}",
-    ]))
-
-    measurements = monica_run_lib.read_csv("data/measurements.csv", key="TRTNO",
-                                           skip_lines=1, empty_value=np.nan)
-    #observations_order = ["GWAM","CWAA","CWAM","CNAM","GNAM","HIAM","GWGM"] ##I NEED TO CHANCE THIS FOR THE STEP" CALIBRATION##
-    #observations_order = ["Z31D", "ADAT", "MDAT"]
-    observations_order = ["GWAM"]
-    observation_treatment_nos = []
-    observations = []
-    for trt_no in sorted(measurements.keys()):
-        if len(treatments) > 0 and trt_no not in treatments:
-            continue
-        observation_treatment_nos.append(trt_no)
-        trt = measurements[trt_no]
-        for output_name in observations_order:
-            v = trt[output_name]
-            if v is np.nan:
-                observations.append(np.nan)
-                continue
-            if output_name in ["Z31D", "ADAT", "MDAT"]:
-                observations.append(int(datetime.fromisoformat(v).timetuple().tm_yday))
-            else:
-                observations.append(float(v))
+    ] + window_args["consumer"]))
 
     # read parameters which are to be calibrated
-    params = []
-    with open("data/calibratethese_step2.csv") as params_csv:
-        dialect = csv.Sniffer().sniff(params_csv.read(), delimiters=';,\t')
-        params_csv.seek(0)
-        reader = csv.reader(params_csv, dialect)
-        next(reader, None)  # skip the header
-        for row in reader:
-            p = {"name": row[0]}
-            if len(row[1]) > 0:
-                p["array"] = row[1].split("|")
-            for n, i in [("low", 2), ("high", 3), ("step", 4), ("optguess", 5), ("minbound", 6), ("maxbound", 7)]:
-                if len(row[i]) > 0:
-                    p[n] = float(row[i])
-            if len(row) == 9 and len(row[8]) > 0:
-                p["derive_function"] = lambda _, _2: eval(row[8])
-            params.append(p)
+    params = calibration_params.read_calibration_params(config["params_csv"])
 
     spot_setup = None
+    path_to_eval_cache = f"{path_to_out_folder}/{config['eval_cache']}" if config["eval_cache"] else None
     spot_setup = calibration_spotpy_setup_MONICA.SpotpySetup(params, observations, observations_order,
                                                              observation_treatment_nos,
                                                              prod_chan_data["writer_sr"],
                                                              cons_chan_data["reader_sr"],
-                                                             path_to_out_folder)
+                                                             path_to_out_folder,
+                                                             path_to_eval_cache=path_to_eval_cache,
+                                                             fidelity_trt_nos=json.loads(
+                                                                 config["fidelity_treatments"] or "[]"),
+                                                             promotion_factor=float(config["promotion_factor"]),
+                                                             abort_factor=float(config["abort_factor"]),
+                                                             channel_host=channel_host)
 
     rep = int(config["repetitions"]) #initial number was 10
     results = []
     #Set up the sampler with the model above
-    sampler = spotpy.algorithms.sceua(spot_setup, dbname=f"{path_to_out_folder}/SCEUA_monica_results", dbformat="csv")
+    # sceua checkpoints its state (dbname.break) after each complex evolution loop,
+    # on resume the evaluations in the results csv are answered from the evaluation cache
+    dbname = f"{path_to_out_folder}/SCEUA_monica_results"
+    resume = config["resume"] and os.path.exists(f"{dbname}.csv")
+    if resume:
+        print(f"{os.path.basename(__file__)} recovered {spot_setup.rebuild_eval_cache(f'{dbname}.csv')} "
+              f"evaluations from {dbname}.csv")
+    checkpoint_mode = "readandwrite" if resume and os.path.exists(f"{dbname}.break") else "write"
+    sampler = spotpy.algorithms.sceua(spot_setup, dbname=dbname, dbformat="csv", breakpoint=checkpoint_mode,
+                                      backup_every_rep=0, dbappend=resume,
+                                      random_state=int(config["random_state"]) if config["random_state"] else None)
     # sampler = spotpy.algorithms.dream(spot_setup, dbname=f"{path_to_out_folder}/{nuts3_region_folder_name}_DREAM_monica_results", dbformat="csv")
+    if config["warm_start"] and not resume:
+        seeds = calibration_results.best_param_sets(config["warm_start"], int(config["warm_start_rows"]))
+        no_of_mapped = calibration_results.seed_initial_population(sampler, seeds)
+        print(f"{os.path.basename(__file__)} warm start: seeding {len(seeds)} parameter sets "
+              f"({no_of_mapped}/{len(spot_setup.params)} parameters mapped) from {config['warm_start']}")
+    parallel_candidates = int(config["parallel_candidates"])
+    if parallel_candidates > 1:
+        # evaluate the burn-in samples, the sceua complexes (or dream chains) concurrently
+        sampler.repeat = calibration_spotpy_setup_MONICA.BatchForEach(sampler.simulate, spot_setup,
+                                                                      parallel_candidates)
     #Run the sampler to produce the paranmeter distribution
     #and identify optimal parameters based on objective function
     #ngs = number of complexes
@@ -226,6 +292,17 @@ async def run_calibration(server=None, prod_port=None, cons_port=None):
     path_to_best_out_file = f"{path_to_out_folder}/best.out"
     with open(path_to_best_out_file, "a") as _:
         print_status_final(sampler.status, _)
+        if spot_setup.eval_cache:
+            print(spot_setup.eval_cache.format_stats(), file=_)
+        if spot_setup.fidelity_trt_nos:
+            print(spot_setup.format_fidelity_stats(), file=_)
+        if spot_setup.abort_factor > 0:
+            print(spot_setup.format_abort_stats(), file=_)
+        if config["warm_start"] or config["cold_start_results"]:
+            for line in calibration_results.convergence_report(
+                    f"{dbname}.csv", config["cold_start_results"],
+                    name="warm start" if config["warm_start"] else "this run"):
+                print(line, file=_)
 
     #with open(path_to_out_folder + "/spot_setup.out", "a") as _:
     #    _.write(f"{datetime.now()} results written run-cal\n\n")
@@ -246,7 +323,7 @@ async def run_calibration(server=None, prod_port=None, cons_port=None):
     fig.savefig(f"{path_to_out_folder}/SCEUA_objectivefunctiontrace_MONICA.png", dpi=150)
     plt.close(fig)
 
-    # kill the two channels and the producer and consumer
+    # kill the (external) channels and the producer and consumer
     for proc in procs:
         proc.terminate()
 
@@ -16,20 +16,27 @@
 # Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
 
 import csv
-from datetime import datetime, timedelta
 import os
 import sys
 from collections import defaultdict
 import zmq
 import shared
 
+import agmip_output
 import monica_io3
+import result_cache
 
 def run_consumer(server=None, port=None):
     config = {
         "port": port if port else "7777",
         "server": server if server else "localhost",
         "path-to-output-dir": "./out",
+        "path-to-data-dir": "./data",
+        "path-to-sim-json": "sim.json",
+        "credit_address": None,  # the producer's credit address, e.g. tcp://localhost:6699
+        "result_cache": None,  # path to the producer's result cache (sqlite) file, to store the received results
+        "result_cache_max_mb": "1024",
+        "cache_address": None,  # the producer's cache address, e.g. tcp://localhost:6698
     }
 
     shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -40,6 +47,19 @@ def run_consumer(server=None, port=None):
 
     socket.RCVTIMEO = 6000
 
+    # credit back each received result to the producer's in-flight window
+    credit_socket = None
+    if config["credit_address"]:
+        credit_socket = context.socket(zmq.PUSH)
+        credit_socket.connect(config["credit_address"])
+
+    # results found in the producer's result cache arrive on the same socket
+    cache = None
+    if config["cache_address"]:
+        socket.connect(config["cache_address"])
+    if config["result_cache"]:
+        cache = result_cache.ResultCache(config["result_cache"], int(config["result_cache_max_mb"]) * 1024 * 1024)
+
     path_to_out_dir = config["path-to-output-dir"]
     if not os.path.exists(path_to_out_dir):
         try:
@@ -48,14 +68,16 @@ def run_consumer(server=None, port=None):
             print(f"{os.path.basename(__file__)} Couldn't create dir {path_to_out_dir}! Exiting.")
             exit(1)
 
+    soil_layer_weights = agmip_output.SoilLayerWeights(f"{config['path-to-data-dir']}/Soil_layers.csv",
+                                                       config["path-to-sim-json"])
+    # one SWC column per output layer of the soil with the most layers
+    no_of_swc_columns = soil_layer_weights.max_no_of_output_layers()
+
     daily_filepath = f"{path_to_out_dir}/Ex_1b_Daily_MONICA_calib_Results.csv"
     daily_f = open(daily_filepath, "wt", newline="", encoding="utf-8")
-    daily_f.write(
-        "Tret: 1 to 13,Day after planting,Zadocks phenology stage,Total above biomass,Leaf Area Index,Daily transpiration,Actual evapotranspiration,Runoff,Deep Percolation,N Leaching,Soil Water Content_layer_1,Soil Water Content_layer_2,Soil Water Content_layer_3,Soil Water Content_layer_4,Soil Water Content_layer_5,Soil Water Content_layer_6,Soil Water Content_layer_7,Soil Water Content_layer_8,Soil Water Content_layer_9,Soil Water Content_layer_10,Soil Water Content_layer_11,Soil Water Content_layer_12,Soil Water Content_layer_13,Soil Water Content_layer_14,Soil Water Content_layer_15\n")
-    daily_f.write(
-        "Treatment,DAP,ZDPH,CWAD,LAI,TRANS,ETa,Roff,DPER,NLEA,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC,SWC\n") ##This needs to change##
-    daily_f.flush()
     daily_writer = csv.writer(daily_f, delimiter=",")
+    daily_writer.writerows(agmip_output.daily_header_rows(no_of_swc_columns))
+    daily_f.flush()
 
     crop_filepath = f"{path_to_out_dir}/Ex_1b_MONICA_calib_Results.csv"
     crop_f = open(crop_filepath, "wt", newline="", encoding="utf-8")
@@ -70,6 +92,8 @@ def run_consumer(server=None, port=None):
     while no_of_trts_to_receive != no_of_trts_received:
         try:
             msg: dict = socket.recv_json()
+            if credit_socket:
+                credit_socket.send(b"1")
 
             if msg.get("errors", []):
                 print(f"{os.path.basename(__file__)} received errors: {msg['errors']}")
@@ -84,6 +108,8 @@ def run_consumer(server=None, port=None):
 
             no_of_trts_received += 1
             trt_no = custom_id.get("trt_no", None)
+            if cache and "env_key" in custom_id and not custom_id.get("cached", False):
+                cache.put(custom_id["env_key"], result_cache.encode_result(msg))
             soil_name = custom_id.get("soil_name", None)
 
             #write_monica_out(trt_no, msg)
@@ -91,44 +117,21 @@ def run_consumer(server=None, port=None):
 
             print(f"{os.path.basename(__file__)} received result trt_no: {trt_no}")
 
-            # [(layer_bottom_depth_cm, layer_index), ...]
-            layers = {
-                "CH5531001": [(5, 0), (10, 0), (20, 1), (30, 2), (40, 3), (50, 4), (60, 5), (70, 6),
-                              (90, (7, 8)), (110, (9, 10)), (130, (11, 12)), (150, (13, 14)),
-                              (170, (15, 16)), (190, (17, 18)), (210, 19)],
-                "CH5531002": [(5, 0), (10, 0), (20, 1), (30, 2), (40, 3), (50, 4), (60, 5), (70, 6),
-                              (90, (7, 8)), (110, (9, 10)), (130, (11, 12)), (150, (13, 14)),
-                              (170, (15, 16)), (190, (17, 18)), (210, 19)],  
-                "LLWatelg": [(5, 0), (15, (0, 1)), (20, 1), (30, 2), (40, 3), (50, 4), (60, 5),
-                               (70, 6), (90, (7, 8)), (110, (9, 10)), (125, (11, 13))],
-                "LLWatelg01": [(5, 0), (15, (0, 1)), (20, 1), (30, 2), (40, 3), (50, 4), (60, 5),
-                               (70, 6), (90, (7, 8)), (110, (9, 10)), (125, (11, 13))]
-            }.get(soil_name, None)
-            if not layers:
+            layer_weights = soil_layer_weights.get(soil_name)
+            if layer_weights is None:
+                print(f"{os.path.basename(__file__)} soil {soil_name} of trt_no: {trt_no} not in Soil_layers.csv")
                 continue
 
+            # the results are rows of objects or (obj-outputs? false) the outputs' columns
             data: dict = msg["data"][0]
-            results: list = data["results"]
-            sowing_date = None
-            for vals in results:
-                if not sowing_date:
-                    sowing_date = vals["Date"]
-                current_date = vals["Date"]
-                dap = (datetime.fromisoformat(current_date) - datetime.fromisoformat(sowing_date)).days
-                swcs = []
-                for layer_bottom_depth_cm, layer_indices in layers:
-                    from_layer_index = layer_index = layer_indices if isinstance(layer_indices, int) else layer_indices[0]
-                    to_layer_index = layer_indices if isinstance(layer_indices, int) else layer_indices[1]
-                    layer_swc_vals = vals["SWC"][from_layer_index:to_layer_index+1]
-                    swcs.append(sum(layer_swc_vals) / len(layer_swc_vals))
-                row = [trt_no, dap, vals["Stage"], vals["CWAD"], vals["LAI"], vals["TRANS"], vals["ETa"],
-                       vals["Roff"], vals["DPER"][0], vals["NLEA"]] + swcs
-                daily_writer.writerow(row)
+            daily_writer.writerows(agmip_output.daily_rows(
+                trt_no, monica_io3.output_columns(data.get("outputIds", []), data["results"]), layer_weights,
+                no_of_swc_columns))
 
             data: dict = msg["data"][1]
-            vals: dict = data["results"][0]
+            vals: dict = monica_io3.first_row(data.get("outputIds", []), data["results"])
             data2: dict = msg["data"][2]
-            vals2: dict = data2["results"][0]
+            vals2: dict = monica_io3.first_row(data2.get("outputIds", []), data2["results"])
             row = [trt_no, vals2["GWAD"], -1, -1, vals["LAID"], vals2["CWAD"], vals2["RWAD"]]
             crop_writer.writerow(row)
 
@@ -137,6 +140,9 @@ def run_consumer(server=None, port=None):
 
     daily_f.close()
     crop_f.close()
+    if cache:
+        print(f"{os.path.basename(__file__)} {cache.format_stats()}")
+        cache.close()
 
     print(f"{os.path.basename(__file__)} exiting run_consumer()")
 
@@ -151,7 +157,7 @@ def write_monica_out(trt_no, msg):
 
     # with open("out/out-" + str(i) + ".csv", 'wb') as _:
     path_to_file = path_to_out_dir + "/trt_no-" + str(trt_no) + ".csv"
-    with open(path_to_file, "w", newline='') as _:
+    with open(path_to_file, "w", newline='', buffering=1 << 16) as _:
         writer = csv.writer(_, delimiter=";")
         for data_ in msg.get("data", []):
             results = data_.get("results", [])
@@ -164,8 +170,7 @@ def write_monica_out(trt_no, msg):
                                                                include_units_row=False,
                                                                include_time_agg=False):
                     writer.writerow(row)
-                for row in monica_io3.write_output_obj(output_ids, results):
-                    writer.writerow(row)
+                writer.writerows(monica_io3.iter_output_rows(output_ids, results))
             writer.writerow([])
     print("wrote:", path_to_file)
 
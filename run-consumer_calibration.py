@@ -17,18 +17,31 @@
 
 import asyncio
 import capnp
-from collections import defaultdict
+from collections import Counter, defaultdict, OrderedDict
 import csv
 from datetime import datetime
 import json
 import os
 import sys
+import time
 import zmq
+import zmq.asyncio
 
+import calibration_objective
 import common
 import monica_io3
+import result_cache
 
 fbp_capnp = capnp.load("capnp_schemas/fbp.capnp", imports=[])
+calibration_capnp = capnp.load("capnp_schemas/calibration.capnp", imports=[])
+
+POLL_TIMEOUT_MS = 1000
+# the deadlines are checked at most this often, also while results keep arriving
+DEADLINE_CHECK_INTERVAL_SECS = 1.0
+MAX_REMEMBERED_CANDIDATES = 10000
+MAX_REMEMBERED_JOBS = 100000
+# the job key of a candidate's done message
+DONE = "done"
 
 PATHS = {
     "remoteConsumer-remoteMonica": {
@@ -39,6 +52,59 @@ PATHS = {
 }
 
 
+class CandidateResults:
+    "the results of the treatments of a single parameter set (candidate)"
+
+    def __init__(self, round_no, job_timeout):
+        self.round = round_no
+        self.job_timeout = job_timeout
+        self.trt_no_to_output_name_to_result = defaultdict(dict)
+        self.received_trt_nos = set()
+        self.expected_trt_nos = None  # known with the done message (or the producer's announcements)
+        self.expected_no_of_trts = None
+        # the announced jobs (trt_no or DONE, resubmission) not received yet -> their deadline
+        self.outstanding_jobs = {}
+        # the received jobs, in case a result overtakes its announcement
+        self.received_jobs = set()
+        self.announced = False
+        # without announcements all jobs share the deadline, which starts with the first message received
+        self.deadline = time.monotonic() + job_timeout
+        self.resubmissions = 0
+        # how often each treatment (or just the done message = DONE) has been resubmitted
+        self.job_resubmissions = Counter()
+
+    def sent(self, job):
+        "the producer has sent the job, it has to arrive within job_timeout secs"
+        self.announced = True
+        if job not in self.received_jobs:
+            self.outstanding_jobs[job] = time.monotonic() + self.job_timeout
+
+    def received(self, job):
+        self.received_jobs.add(job)
+        self.outstanding_jobs.pop(job, None)
+
+    def expired_jobs(self, now):
+        return [job for job, deadline in self.outstanding_jobs.items() if deadline <= now]
+
+    def is_overdue(self, now):
+        "is an announced job overdue or, without announcements, the candidate's results"
+        if self.announced:
+            # nothing outstanding = the producer waits for the in-flight window
+            return any(deadline <= now for deadline in self.outstanding_jobs.values())
+        return self.deadline <= now
+
+    def missing_trt_nos(self):
+        "the treatments not received yet, None if unknown"
+        if self.expected_trt_nos is None:
+            return None
+        return self.expected_trt_nos - self.received_trt_nos
+
+    def is_complete(self):
+        if self.expected_no_of_trts is not None:
+            return len(self.received_trt_nos) >= self.expected_no_of_trts
+        return self.expected_trt_nos is not None and len(self.missing_trt_nos()) == 0
+
+
 async def run_consumer(server=None, port=None):
     """collect data from workers"""
 
@@ -48,7 +114,18 @@ async def run_consumer(server=None, port=None):
         "server": server if server else "localhost",  # "login01.cluster.zalf.de",
         "writer_sr": None,
         "path_to_out": "out/",
-        "timeout": 600000  # 10min
+        "timeout": 600000,  # 10min
+        "credit_address": None,  # the producer's credit address, e.g. tcp://localhost:6699
+        "result_cache": None,  # path to the producer's result cache (sqlite) file, to store the received results
+        "result_cache_max_mb": "1024",
+        "cache_address": None,  # the producer's cache address, e.g. tcp://localhost:6698
+        "resubmit_address": None,  # the producer's resubmit address, e.g. tcp://localhost:6697
+        "announce_address": None,  # the producer's announce address, e.g. tcp://localhost:6696
+        "job_timeout": "300",  # secs after which the missing results of a sent job (candidate) are requested again
+        "max_resubmissions": "3",  # afterwards the candidate is given back without the missing results
+        "stream_results": False,  # also send each treatment's results as soon as they arrive
+        "sim_vector": None,  # json {"trt_nos": [...], "outputs": [...]} = send just the simulated vector to match
+                             # the observations (as ResultMatrix), instead of all results
     }
 
     common.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
@@ -62,62 +139,246 @@ async def run_consumer(server=None, port=None):
     with open(path_to_out_file, "a") as _:
         _.write(f"config: {config}\n")
 
-    context = zmq.Context()
+    context = zmq.asyncio.Context()
     socket = context.socket(zmq.PULL)
 
     socket.connect("tcp://" + config["server"] + ":" + config["port"])
-    socket.RCVTIMEO = config["timeout"]
 
-    trt_no_to_output_name_to_result = defaultdict(dict)
+    # credit back each received result to the producer's in-flight window
+    credit_socket = None
+    if config["credit_address"]:
+        credit_socket = context.socket(zmq.PUSH)
+        credit_socket.connect(config["credit_address"])
+
+    # results found in the producer's result cache arrive on the same socket
+    cache = None
+    if config["cache_address"]:
+        socket.connect(config["cache_address"])
+    # ... and so do the producer's announcements of the sent jobs
+    if config["announce_address"]:
+        socket.connect(config["announce_address"])
+    if config["result_cache"]:
+        cache = result_cache.ResultCache(config["result_cache"], int(config["result_cache_max_mb"]) * 1024 * 1024)
+
+    resubmit_socket = None
+    if config["resubmit_address"]:
+        resubmit_socket = context.socket(zmq.PUSH)
+        resubmit_socket.connect(config["resubmit_address"])
+    job_timeout = float(config["job_timeout"])
+    max_resubmissions = int(config["max_resubmissions"])
+
+    # the results of each parameter set (candidate) are collected separately, as they may arrive interleaved
+    candidate_to_results = {}
+    # candidates already given back, later (duplicate) results for them are dropped
+    completed_candidates = OrderedDict()
+    # the jobs (candidate, trt_no or DONE, resubmission) received or given up on, credited back already
+    settled_jobs = OrderedDict()
+    # the jobs sent for already completed candidates (e.g. queued resubmissions) -> their deadline
+    late_jobs = {}
+
+    sim_vector = calibration_objective.SimVector.from_spec(json.loads(config["sim_vector"])) \
+        if config["sim_vector"] else None
 
     conman = common.ConnectionManager()
     writer = await conman.try_connect(config["writer_sr"], cast_as=fbp_capnp.Channel.Writer, retry_secs=1)  #None
 
-    no_of_trts_received = 0
-    no_of_trts_expected = None
+    def log(text):
+        with open(path_to_out_file, "a") as _:
+            _.write(f"{datetime.now()} {text}\n")
+        print(text)
+
+    async def complete(candidate, cr):
+        if writer:
+            attributes = [{"key": k, "value": v} for k, v in [("round", cr.round), ("candidate", candidate)] if v]
+            if sim_vector:
+                content = calibration_capnp.ResultMatrix.new_message(
+                    trtNos=sim_vector.trt_nos, values=sim_vector.vector(cr.trt_no_to_output_name_to_result).tolist())
+                attributes.append({"key": "content_type", "value": "ResultMatrix"})
+            else:
+                content = json.dumps(cr.trt_no_to_output_name_to_result)
+            out_ip = fbp_capnp.IP.new_message(content=content, attributes=attributes)
+            await writer.write(value=out_ip)
+        await forget(candidate)
+
+    async def stream(candidate, cr, trt_no):
+        if writer:
+            attributes = [{"key": k, "value": v} for k, v in [("round", cr.round), ("candidate", candidate),
+                                                               ("trt_no", str(trt_no))] if v]
+            output_name_to_result = cr.trt_no_to_output_name_to_result[trt_no]
+            if sim_vector:
+                content = calibration_capnp.ResultMatrix.new_message(
+                    trtNos=[trt_no], values=[float(v) for v in sim_vector.values(output_name_to_result)])
+                attributes.append({"key": "content_type", "value": "ResultMatrix"})
+            else:
+                content = json.dumps(output_name_to_result)
+            out_ip = fbp_capnp.IP.new_message(content=content, attributes=attributes)
+            await writer.write(value=out_ip)
+
+    def settle(candidate, job):
+        "is the job new, then remember it as settled, each job frees just one slot in the in-flight window"
+        if candidate is None:
+            # without candidate ids the jobs of different rounds can't be told apart
+            return True
+        key = (candidate, *job)
+        if key in settled_jobs:
+            return False
+        settled_jobs[key] = True
+        if len(settled_jobs) > MAX_REMEMBERED_JOBS:
+            settled_jobs.popitem(last=False)
+        return True
+
+    async def write_off(candidate, jobs):
+        "give up on the jobs (MONICA lost them) and free their slots in the producer's in-flight window"
+        no_of_jobs = len([job for job in jobs if settle(candidate, job)])
+        if credit_socket and no_of_jobs > 0:
+            await credit_socket.send(str(no_of_jobs).encode())
+
+    async def forget(candidate):
+        cr = candidate_to_results.pop(candidate)
+        # e.g. the resubmitted jobs of treatments which arrived late after all
+        await write_off(candidate, list(cr.outstanding_jobs))
+        # without candidate ids every round is the same (None) candidate
+        if candidate is not None:
+            completed_candidates[candidate] = True
+            if len(completed_candidates) > MAX_REMEMBERED_CANDIDATES:
+                completed_candidates.popitem(last=False)
+
+    async def check_deadlines():
+        now = time.monotonic()
+        for (candidate, job), deadline in list(late_jobs.items()):
+            if deadline <= now:
+                del late_jobs[(candidate, job)]
+                await write_off(candidate, [job])
+        for candidate, cr in list(candidate_to_results.items()):
+            if not cr.is_overdue(now):
+                continue
+            expired = cr.expired_jobs(now)
+            for job in expired:
+                del cr.outstanding_jobs[job]
+            await write_off(candidate, expired)
+            if cr.announced:
+                # just the lost jobs, the others are still on their way (or wait for the in-flight window)
+                missing = {trt_no for trt_no, _ in expired if trt_no != DONE} - cr.received_trt_nos
+            else:
+                missing = cr.missing_trt_nos()
+            jobs = missing if missing else {DONE}
+            if resubmit_socket and max(cr.job_resubmissions[job] for job in jobs) < max_resubmissions:
+                # without the done message the producer will send it again (with the list of treatments)
+                cr.resubmissions += 1
+                cr.job_resubmissions.update(jobs)
+                req = {"candidate": candidate, "trt_nos": sorted(missing) if missing is not None else [],
+                       "resubmission": cr.resubmissions}
+                if cr.round:
+                    req["round"] = cr.round
+                await resubmit_socket.send_json(req)
+                cr.deadline = now + job_timeout
+                log(f"resubmitted candidate: {candidate} missing trt_nos: {req['trt_nos']} "
+                    f"({cr.resubmissions}. time)")
+            else:
+                missing = cr.missing_trt_nos()
+                log(f"giving up on candidate: {candidate} missing trt_nos: "
+                    f"{sorted(missing) if missing is not None else 'unknown'}")
+                await complete(candidate, cr)
 
+    last_msg_time = time.monotonic()
+    last_deadline_check = time.monotonic()
     while True:
         try:
-            msg: dict = socket.recv_json()  # encoding="latin-1"
+            if time.monotonic() - last_deadline_check >= DEADLINE_CHECK_INTERVAL_SECS:
+                last_deadline_check = time.monotonic()
+                await check_deadlines()
+            if await socket.poll(POLL_TIMEOUT_MS) == 0:
+                if (time.monotonic() - last_msg_time) * 1000 > int(config["timeout"]):
+                    log(f"no response from the server (with {config['timeout']} ms timeout)")
+                    last_msg_time = time.monotonic()
+                continue
+            last_msg_time = time.monotonic()
+
+            msg: dict = await socket.recv_json()  # encoding="latin-1"
 
             custom_id = msg["customId"]
-            if "no_of_trts" in custom_id:
-                no_of_trts_expected = custom_id["no_of_trts"]
+            candidate = custom_id.get("candidate", None)
+            if custom_id.get("announce", False):
+                # the producer has sent a job of the candidate (announcements don't take a window slot)
+                job = (custom_id["job"], custom_id.get("resubmission", 0))
+                if candidate in completed_candidates:
+                    late_jobs[(candidate, job)] = time.monotonic() + job_timeout
+                    continue
+                cr = candidate_to_results.get(candidate, None)
+                if cr is None:
+                    cr = candidate_to_results[candidate] = CandidateResults(custom_id.get("round", None), job_timeout)
+                if cr.expected_trt_nos is None:
+                    cr.expected_trt_nos = set(custom_id["trt_nos"])
+                cr.sent(job)
+                continue
+
+            # the jobs given up on (and duplicates) have been credited back already
+            job = (DONE if custom_id.get("nodata", False) else custom_id.get("trt_no", None),
+                   custom_id.get("resubmission", 0))
+            if settle(candidate, job) and credit_socket:
+                await credit_socket.send(b"1")
+
+            if candidate in completed_candidates:
+                late_jobs.pop((candidate, job), None)
+                print(f"dropping late or duplicate result of candidate: {candidate}")
+                continue
+            cr = candidate_to_results.get(candidate, None)
+            if cr is None:
+                cr = candidate_to_results[candidate] = CandidateResults(custom_id.get("round", None), job_timeout)
+            cr.received(job)
+
+            if custom_id.get("nodata", False):
+                if custom_id.get("cancelled", False):
+                    # the candidate was aborted, the results still on the way will be dropped
+                    log(f"candidate {candidate} was cancelled")
+                    await forget(candidate)
+                    continue
+                if "trt_nos" in custom_id:
+                    cr.expected_trt_nos = set(custom_id["trt_nos"])
+                else:
+                    # older producers just send the number of treatments
+                    cr.expected_no_of_trts = custom_id.get("no_of_trts", None)
             else:
-                no_of_trts_received += 1
-
                 #with open(path_to_out_file, "a") as _:
                 #    _.write(f"received result customId: {custom_id}\n")
                 #print("received result customId:", custom_id)
 
                 trt_no = custom_id["trt_no"]
+                if trt_no in cr.received_trt_nos:
+                    print(f"dropping duplicate result of candidate: {candidate} trt_no: {trt_no}")
+                    continue
+                cr.received_trt_nos.add(trt_no)
+
+                if cache and "env_key" in custom_id and not custom_id.get("cached", False) \
+                        and not msg.get("errors", []):
+                    cache.put(custom_id["env_key"], result_cache.encode_result(msg))
 
                 #write_monica_out(trt_no, msg)
                 #continue
 
+                trt_no_to_output_name_to_result = cr.trt_no_to_output_name_to_result
+                needed_output_names = sim_vector.needed_output_names if sim_vector else None
                 for data in msg.get("data", []):
                     results = data.get("results", [])
-                    for vals in results:
-                        for output_name, val in vals.items():
-                            trt_no_to_output_name_to_result[trt_no][output_name] = val
-
-            if no_of_trts_expected == no_of_trts_received and writer:
-                with open(path_to_out_file, "a") as _:
-                    _.write(f"{datetime.now()} last expected env received\n")
-
-                out_ip = fbp_capnp.IP.new_message(content=json.dumps(trt_no_to_output_name_to_result))
-                await writer.write(value=out_ip)
+                    if monica_io3.results_are_objs(results):
+                        for vals in results:
+                            for output_name, val in vals.items():
+                                if needed_output_names is None or output_name in needed_output_names:
+                                    trt_no_to_output_name_to_result[trt_no][output_name] = val
+                    else:
+                        # obj-outputs? false: the outputs' columns, the last row counts
+                        columns = monica_io3.output_columns(data.get("outputIds", []), results)
+                        for output_name, column in columns.items():
+                            if len(column) > 0 and (needed_output_names is None
+                                                    or output_name in needed_output_names):
+                                trt_no_to_output_name_to_result[trt_no][output_name] = column[-1]
+                if config["stream_results"]:
+                    await stream(candidate, cr, trt_no)
+
+            if cr.is_complete():
+                log(f"last expected env of candidate {candidate} received")
+                await complete(candidate, cr)
 
-                # reset and wait for next round
-                trt_no_to_output_name_to_result.clear()
-                no_of_trts_expected = None
-                no_of_trts_received = 0
-
-        except zmq.error.Again as _e:
-            with open(path_to_out_file, "a") as _:
-                _.write(f"no response from the server (with {socket.RCVTIMEO} ms timeout)\n")
-            print('no response from the server (with "timeout"=%d ms) ' % socket.RCVTIMEO)
-            continue
         except Exception as e:
             with open(path_to_out_file, "a") as _:
                 _.write(f"Exception: {e}\n")
@@ -138,7 +399,7 @@ def write_monica_out(trt_no, msg):
 
     # with open("out/out-" + str(i) + ".csv", 'wb') as _:
     path_to_file = path_to_out_dir + "/trt_no-" + str(trt_no) + ".csv"
-    with open(path_to_file, "w", newline='') as _:
+    with open(path_to_file, "w", newline='', buffering=1 << 16) as _:
         writer = csv.writer(_, delimiter=",")
         for data_ in msg.get("data", []):
             results = data_.get("results", [])
@@ -151,8 +412,7 @@ def write_monica_out(trt_no, msg):
                                                                include_units_row=True,
                                                                include_time_agg=False):
                     writer.writerow(row)
-                for row in monica_io3.write_output_obj(output_ids, results):
-                    writer.writerow(row)
+                writer.writerows(monica_io3.iter_output_rows(output_ids, results))
             writer.writerow([])
     print("wrote:", path_to_file)
 
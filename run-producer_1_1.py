@@ -17,24 +17,34 @@
 
 import asyncio
 import capnp
-from collections import defaultdict
-import csv
+from collections import defaultdict, OrderedDict
 import copy
 import json
 import os
 import sys
 import zmq
+import zmq.asyncio
 
 import monica_io3
 import shared
 import common
+import calibration_params
+import credit_window
+import env_assembly
+import env_serializer
+import experiment_tables
+import result_cache
+import weather_store
 
 fbp_capnp = capnp.load("capnp_schemas/fbp.capnp", imports=[])
+calibration_capnp = capnp.load("capnp_schemas/calibration.capnp", imports=[])
+
+MAX_RESUBMITTABLE_CANDIDATES = 10000
 
 
 async def run_producer(server=None, port=None, calibration=False):
 
-    context = zmq.Context()
+    context = zmq.asyncio.Context()
     socket = context.socket(zmq.PUSH)  # pylint: disable=no-member
 
     config = {
@@ -49,13 +59,48 @@ async def run_producer(server=None, port=None, calibration=False):
         "monica_path_to_climate_dir": "C:/Users/palka/GitHub/agmip_waterlogging/data",
         #"monica_path_to_climate_dir": "/home/berg/GitHub/agmip_waterlogging/data",
         "path_to_data_dir": "./data/",
+        "env_snapshot_dir": "./data/__envcache__",  # the resolved env is reused from here until an input changes, "" = off
+        "obj_outputs": None,  # true/false = override sim.json's obj-outputs? (false = MONICA sends the outputs' columns)
         "path_to_out": "out/",
         "treatments": "[]",
         "reader_sr": None,
+        "params_csv": None,  # the calibratethese csv, to resolve the calibration parameters up front
+        "env_stats": False,  # report time and allocations per assembled env
+        "embed_climate": False,  # send the climate data within the env instead of a path to the climate csv
+        "weather_store": None,  # path to a weather store file (see weather_store.py) to embed the climate data from
+        "max_in_flight": "0",  # > 0 = max number of jobs sent, but not yet received by the consumer
+        "credit_address": None,  # bind address for the consumer's credits, e.g. tcp://*:6699
+        "result_cache": None,  # path to the result cache (sqlite) file, cached results go straight to the consumer
+        "cache_address": None,  # bind address to send the cached results to the consumer, e.g. tcp://*:6698
+        "resubmit_address": None,  # bind address for the consumer's resubmission requests, e.g. tcp://*:6697
+        "announce_address": None,  # bind address to announce each sent job to the consumer, e.g. tcp://*:6696
     }
     shared.update_config(config, sys.argv, print_config=True, allow_new_keys=False)
 
+    max_in_flight = int(config["max_in_flight"])
+    if max_in_flight > 0:
+        socket.setsockopt(zmq.SNDHWM, max_in_flight)
     socket.connect("tcp://" + config["server"] + ":" + config["server-port"])
+    window = credit_window.CreditWindow(context, config["credit_address"], max_in_flight)
+
+    cache = cache_socket = None
+    if config["result_cache"]:
+        if not config["cache_address"]:
+            raise ValueError("A result cache needs a cache_address to send the cached results to the consumer!")
+        cache = result_cache.ResultCache(config["result_cache"])
+        cache_socket = context.socket(zmq.PUSH)  # pylint: disable=no-member
+        cache_socket.bind(config["cache_address"])
+
+    resubmit_socket = None
+    if config["resubmit_address"]:
+        resubmit_socket = context.socket(zmq.PULL)  # pylint: disable=no-member
+        resubmit_socket.bind(config["resubmit_address"])
+
+    # the consumer learns about each job when it is sent, so it can give up on the lost ones
+    announce_socket = None
+    if config["announce_address"]:
+        announce_socket = context.socket(zmq.PUSH)  # pylint: disable=no-member
+        announce_socket.bind(config["announce_address"])
 
     treatments = json.loads(config["treatments"])
 
@@ -77,241 +122,362 @@ async def run_producer(server=None, port=None, calibration=False):
     fert_template = crop_json.pop("fert_template")
     irrig_template = crop_json.pop("irrig_template")
 
-    env_template = monica_io3.create_env_json_from_json_config({
+    crop_site_sim = {
         "crop": crop_json,
         "site": site_json,
         "sim": sim_json,
         "climate": ""  # climate_csv
-    })
+    }
+    if config["env_snapshot_dir"]:
+        env_template = monica_io3.create_env_json_from_json_config_cached(crop_site_sim, config["env_snapshot_dir"])
+    else:
+        env_template = monica_io3.create_env_json_from_json_config(crop_site_sim)
+    if config["obj_outputs"] is not None:
+        env_template["outputs"]["obj-outputs?"] = config["obj_outputs"]
 
     worksteps: list = copy.deepcopy(env_template["cropRotation"][0]["worksteps"])
 
+    data_dir = config['path_to_data_dir']
+    store = weather_store.WeatherStore(config["weather_store"]) if config["weather_store"] else None
+
     soil_profiles = defaultdict(list)
-    with open(f"{config['path_to_data_dir']}/Soil_layers.csv") as file:
-        dialect = csv.Sniffer().sniff(file.read(), delimiters=';,\t')
-        file.seek(0)
-        reader = csv.reader(file, dialect)
-        next(reader)
-        next(reader)
-        prev_depth_m = 0
-        prev_soil_name = None
-        for line in reader:
-            soil_name = line[0]
-            if soil_name != prev_soil_name:
-                prev_soil_name = soil_name
-                prev_depth_m = 0
-            current_depth_m = float(line[1])/100.0
-            thickness = round(current_depth_m - prev_depth_m, 1)
-            prev_depth_m = current_depth_m
-            layer = {
-                "Thickness": [thickness, "m"],
-                "PoreVolume": [float(line[2]), "m3/m3"],
-                "FieldCapacity": [float(line[3]), "m3/m3"],
-                "PermanentWiltingPoint": [float(line[5]), "m3/m3"],
-                "Lambda": float(line[9]),
-                "SoilBulkDensity": [float(line[10])*1000.0, "kg/m3"],
-                "SoilOrganicCarbon": [float(line[11]), "%"],
-                "Clay": [float(line[12])/100.0, "m3/m3"],
-                "Sand": [float(line[14])/100.0, "m3/m3"],
-                "Sceleton": [float(line[15]), "m3/m3"],
-                "pH": float(line[18])
-            }
-            soil_profiles[soil_name].append(layer)
+    soil_layers = experiment_tables.load_table(f"{data_dir}/Soil_layers.csv")
+    prev_depth_m = 0
+    prev_soil_name = None
+    for i, soil_name in enumerate(soil_layers.raw["SOIL_NAME"]):
+        if soil_name != prev_soil_name:
+            prev_soil_name = soil_name
+            prev_depth_m = 0
+        current_depth_m = float(soil_layers["SLLB"][i])/100.0
+        thickness = round(current_depth_m - prev_depth_m, 1)
+        prev_depth_m = current_depth_m
+        layer = {
+            "Thickness": [thickness, "m"],
+            "PoreVolume": [float(soil_layers["SLSAT"][i]), "m3/m3"],
+            "FieldCapacity": [float(soil_layers["SLFC1"][i]), "m3/m3"],
+            "PermanentWiltingPoint": [float(soil_layers["SLWP"][i]), "m3/m3"],
+            "Lambda": float(soil_layers["SKSAT"][i]),
+            "SoilBulkDensity": [float(soil_layers["SLBDM"][i])*1000.0, "kg/m3"],
+            "SoilOrganicCarbon": [float(soil_layers["SLOC"][i]), "%"],
+            "Clay": [float(soil_layers["SLCLY"][i])/100.0, "m3/m3"],
+            "Sand": [float(soil_layers["SLSND"][i])/100.0, "m3/m3"],
+            "Sceleton": [float(soil_layers["SLCF"][i]), "m3/m3"],
+            "pH": float(soil_layers["SLHW"][i])
+        }
+        soil_profiles[soil_name].append(layer)
 
     trt_no_to_fertilizers = defaultdict(dict)
-    with open(f"{config['path_to_data_dir']}/Fertilizers.csv") as file:
-        dialect = csv.Sniffer().sniff(file.read(), delimiters=';,\t')
-        file.seek(0)
-        reader = csv.reader(file, dialect)
-        next(reader)
-        next(reader)
-        for line in reader:
-            fert_temp = copy.deepcopy(fert_template)  # fert_template --> crop json
-            trt_no = int(line[0])  # trt_no
-            fert_temp["date"] = line[2]  # date
-            fert_temp["partition"][2] = line[3]  # fertilizer_material
-            fert_temp["amount"][0] = float(line[6])  # N_in_applied_fertilizer
-            trt_no_to_fertilizers[trt_no][fert_temp["date"]] = fert_temp
+    ferts = experiment_tables.load_table(f"{data_dir}/Fertilizers.csv")
+    for trt_no, date, material, amount in zip(ferts["TRTNO"].tolist(), ferts.raw["FEDATE"],
+                                              ferts.raw["FECD"], ferts["FEAMN"].tolist()):
+        fert_temp = copy.deepcopy(fert_template)  # fert_template --> crop json
+        fert_temp["date"] = date
+        fert_temp["partition"][2] = material  # fertilizer_material
+        fert_temp["amount"][0] = float(amount)  # N_in_applied_fertilizer
+        trt_no_to_fertilizers[trt_no][date] = fert_temp
 
     trt_no_to_irrigation = defaultdict(dict)
-    with open(f"{config['path_to_data_dir']}/Irrigations.csv") as file:
-        dialect = csv.Sniffer().sniff(file.read(), delimiters=';,\t')
-        file.seek(0)
-        reader = csv.reader(file, dialect)
-        next(reader)
-        next(reader)
-        for line in reader:
-            irrig_temp = copy.deepcopy(irrig_template)
-            trt_no = int(line[0])  # TRTNO
-            irrig_temp["date"] = line[2]  # date
-            irrig_temp["amount"][0] = float(line[4])  # irrig_amount_depth
-            trt_no_to_irrigation[trt_no][irrig_temp["date"]] = irrig_temp
+    irrigs = experiment_tables.load_table(f"{data_dir}/Irrigations.csv")
+    for trt_no, date, amount in zip(irrigs["TRTNO"].tolist(), irrigs.raw["IDATE"], irrigs["IRVAL"].tolist()):
+        irrig_temp = copy.deepcopy(irrig_template)
+        irrig_temp["date"] = date
+        irrig_temp["amount"][0] = float(amount)  # irrig_amount_depth
+        trt_no_to_irrigation[trt_no][date] = irrig_temp
 
     trt_no_to_plant = defaultdict(dict)
-    with open(f"{config['path_to_data_dir']}/Plantings.csv") as file:
-        dialect = csv.Sniffer().sniff(file.read(), delimiters=';,\t')
-        file.seek(0)
-        reader = csv.reader(file, dialect)
-        next(reader)
-        next(reader)
-        for line in reader:
-            copy.deepcopy(irrig_template)
-            trt_no = int(line[0])  # trt_no
-            trt_no_to_plant[trt_no]["PDATE"] = line[2]  # date
-            trt_no_to_plant[trt_no]["PLPOP"] = float(line[5])  # plant_pop_at_planting
-            # trt_no_to_plant[trt_no]["PLPOE"] = line[6]
-            trt_no_to_plant[trt_no]["PLRS"] = float(line[7])  # row_spacing
-            trt_no_to_plant[trt_no]["PLDP"] = float(line[9])  # planting_depth
-            
+    plantings = experiment_tables.load_table(f"{data_dir}/Plantings.csv")
+    for i, trt_no in enumerate(plantings["TRTNO"].tolist()):
+        trt_no_to_plant[trt_no]["PDATE"] = plantings.raw["PDATE"][i]  # date
+        trt_no_to_plant[trt_no]["PLPOP"] = float(plantings["PLPOP"][i])  # plant_pop_at_planting
+        trt_no_to_plant[trt_no]["PLRS"] = float(plantings["PLRS"][i])  # row_spacing
+        trt_no_to_plant[trt_no]["PLDP"] = float(plantings["PLDP"][i])  # planting_depth
 
     trt_no_to_meta = defaultdict(dict)
-    with open(f"{config['path_to_data_dir']}/Meta.csv") as file:
-        dialect = csv.Sniffer().sniff(file.read(), delimiters=';,\t')
-        file.seek(0)
-        reader = csv.reader(file, dialect)
-        next(reader)
-        header = next(reader)
-        for line in reader:
-            for i, h in enumerate(header):
-                trt_no_to_meta[int(line[0])][h] = line[i]
+    metas = experiment_tables.load_table(f"{data_dir}/Meta.csv")
+    for i, trt_no in enumerate(metas["TRTNO"].tolist()):
+        trt_no_to_meta[trt_no].update(metas.raw_row(i))
+
+    trt_no_to_events = env_assembly.create_event_records(trt_no_to_fertilizers, trt_no_to_irrigation)
+    trt_no_to_events_json = {trt_no: env_assembly.encode_event_records(events)
+                             for trt_no, events in trt_no_to_events.items()}
 
     # if calibration connect to reader for new parameters
     conman = reader = None
     if calibration:
+        param_setters = calibration_params.ParameterSetters(worksteps[0]["crop"]["cropParams"]["species"],
+                                                            worksteps[0]["crop"]["cropParams"]["cultivar"],
+                                                            env_template["params"]["userCropParameters"])
+        if config["params_csv"]:
+            param_setters.compile(calibration_params.sent_param_names(
+                calibration_params.read_calibration_params(config["params_csv"])))
         conman = common.ConnectionManager()
         reader = await conman.try_connect(config["reader_sr"], cast_as=fbp_capnp.Channel.Reader, retry_secs=1)
 
-    iter_count = 0
-    while True:
-        if calibration:
-            msg = await reader.read()
-            # check for end of data from in port
-            if msg.which() == "done":
-                break
-
-            # with open(config["path_to_out"] + "/spot_setup.out", "a") as _:
-            #    _.write(f"{datetime.now()} connected\n")
-
-            try:
-                in_ip = msg.value.as_struct(fbp_capnp.IP)
-                s: str = in_ip.content.as_text()
-                params: dict = json.loads(s)  # keys: MaxAssimilationRate, AssimilateReallocation, RootPenetrationRate
-
-                sowing_ws: dict = worksteps[0]
-                ps = sowing_ws["crop"]["cropParams"]
-                cps = env_template["params"]["userCropParameters"]
-                for pname, pval in params.items():
-                    pname_arr = pname.split("_")
-                    i = j = None
-                    if len(pname_arr) >= 2:
-                        pname = pname_arr[0]
-                        i = int(pname_arr[1]) - 1  # for the user we start counting at 1
-                        if len(pname_arr) >= 3:
-                            j = int(pname_arr[2]) - 1  # for the user we start counting at 1
-                    if pname in ps["species"] or ("=" in ps["species"] and pname in ps["species"]["="]):
-                        old_val = ps["species"][pname]
-                        if isinstance(old_val, list) and len(old_val) > 1 and isinstance(old_val[1], str):
-                            ps["species"][pname] = old_val[0]
-                        if i is not None:
-                            if len(ps["species"][pname]) > i:
-                                if j is not None:
-                                    if len(ps["species"][pname][i]) > j:
-                                        ps["species"][pname][i][j] = pval
-                                else:
-                                    ps["species"][pname][i] = pval
-                        else:
-                            ps["species"][pname] = pval
-                    elif pname in ps["cultivar"] or ("=" in ps["cultivar"] and pname in ps["cultivar"]["="]):
-                        old_val = ps["cultivar"][pname]
-                        if isinstance(old_val, list) and len(old_val) > 1 and isinstance(old_val[1], str):
-                            ps["cultivar"][pname] = old_val[0]
-                        if i is not None:
-                            if len(ps["cultivar"][pname]) > i:
-                                if j is not None:
-                                    if len(ps["cultivar"][pname][i]) > j:
-                                        ps["cultivar"][pname][i][j] = pval
-                                else:
-                                    ps["cultivar"][pname][i] = pval
-                        else:
-                            ps["cultivar"][pname] = pval
-                    elif pname in cps or ("=" in cps and pname in cps["="]):
-                        old_val = cps[pname]
-                        if isinstance(old_val, list) and len(old_val) > 1 and isinstance(old_val[1], str):
-                            cps[pname] = old_val[0]
-                        if i is not None:
-                            if len(cps[pname]) > i:
-                                if j is not None:
-                                    if len(cps[pname][i]) > j:
-                                        cps[pname][i][j] = pval
-                                else:
-                                    cps[pname][i] = pval
-                        else:
-                            cps[pname] = pval
-            except Exception as e:
-                print(f"{os.path.basename(__file__)} exception: {e}")
-                raise e
-
-        no_of_trts = 0
+    # the invariant parts of the env are encoded only once, just the slots are encoded per job
+    env_template["csvViaHeaderOptions"] = sim_json["climate.csv-options"]
+    env_slots = {
+        "userCropParameters": ("params", "userCropParameters"),
+        "SoilProfileParameters": ("params", "siteParameters", "SoilProfileParameters"),
+        "HeightNN": ("params", "siteParameters", "HeightNN"),
+        "Latitude": ("params", "siteParameters", "Latitude"),
+        "worksteps": ("cropRotation", 0, "worksteps"),
+        "pathToClimateCSV": ("pathToClimateCSV",),
+    }
+    if config["embed_climate"]:
+        env_slots["climateData"] = ("climateData",)
+    env_slots["customId"] = ("customId",)
+    env_tmpl = env_serializer.JsonTemplate(env_template, env_slots)
+    static_ws_jsons = [json.dumps(ws) for ws in worksteps[1:-1]]
+    harvest_tmpl = env_serializer.JsonTemplate(worksteps[-1], {"latest-date": ("latest-date",)})
+    env_values = {}
+    stats = env_assembly.AssemblyStats(trace_allocations=True) if config["env_stats"] else None
+
+    def encode_envs(params, candidate_id, trt_nos=None, candidate_trt_nos=None):
+        """
+        encode the envs of the candidate's treatments (all or candidate_trt_nos) or just the given trt_nos of them
+        for the calibration parameters, returns the jobs [(socket, bytes, trt_no)], the candidate's treatments,
+        soil name and if the candidate has been cancelled, the shared template is changed on the way,
+        so this must not await anything
+        """
+        if params is not None:
+            param_setters.apply(params)
+
+        # calibration parameters might have changed, so re-encode the parts containing them
+        env_values["userCropParameters"] = env_serializer.Raw(json.dumps(env_template["params"]["userCropParameters"]))
+        sowing_tmpl = env_serializer.JsonTemplate(worksteps[0], {"date": ("date",), "PlantDensity": ("PlantDensity",)})
+
+        jobs = []
+        sent_trt_nos = []
+        soil_name = None
+        cancelled = False
         for trt_no, meta in trt_no_to_meta.items():
             if len(treatments) > 0 and trt_no not in treatments:
                 continue
+            if candidate_trt_nos is not None and int(trt_no) not in candidate_trt_nos:
+                continue
+            soil_name = meta["SOIL_ID"]
+            sent_trt_nos.append(int(trt_no))
+            if trt_nos is not None and int(trt_no) not in trt_nos:
+                continue
+            if candidate_id.get("candidate", None) in cancelled_candidates:
+                # the remaining jobs of an aborted candidate are skipped
+                cancelled = True
+                break
 
-            env_template["csvViaHeaderOptions"] = sim_json["climate.csv-options"]
-            env_template["pathToClimateCSV"] = \
-                f"{config['monica_path_to_climate_dir']}/Weather_daily_{meta['WST_ID']}.csv"
-
-            env_template["params"]["siteParameters"]["SoilProfileParameters"] = soil_profiles[meta['SOIL_ID']]
+            if stats:
+                stats.start()
+
+            if config["embed_climate"]:
+                # parsed and encoded just once per weather station
+                env_values["pathToClimateCSV"] = ""
+                if store:
+                    climate_json = store.climate_data_json(meta['WST_ID'], sim_json["climate.csv-options"])
+                else:
+                    climate_json = monica_io3.read_climate_data_json_cached(
+                        f"{data_dir}/Weather_daily_{meta['WST_ID']}.csv", sim_json["climate.csv-options"])
+                env_values["climateData"] = env_serializer.Raw(climate_json)
+            else:
+                env_values["pathToClimateCSV"] = \
+                    f"{config['monica_path_to_climate_dir']}/Weather_daily_{meta['WST_ID']}.csv"
+
+            env_values["SoilProfileParameters"] = soil_profiles[meta['SOIL_ID']]
             #env_template["params"]["siteParameters"]["SoilProfileParameters"] = site_json[meta['SOIL_ID']]
 
 
-            env_template["params"]["siteParameters"]["HeightNN"] = float(meta["FLELE"])
-            env_template["params"]["siteParameters"]["Latitude"] = float(meta["FL_LAT"])
+            env_values["HeightNN"] = float(meta["FLELE"])
+            env_values["Latitude"] = float(meta["FL_LAT"])
             env_template["cropRotation"][0]["worksteps"][0]["crop"]["cropParams"]["cultivar"]["CropSpecificMaxRootingDepth"] = float(meta["SLRTD"])
             #env_template["params"]["siteParameters"]["Slope"] = float(site["Slope"])
 
             # complete crop rotation
-            dates = set()
-            dates.update(trt_no_to_fertilizers[trt_no].keys())
-            dates.update(trt_no_to_irrigation[trt_no].keys())
-
-            worksteps_copy = copy.deepcopy(worksteps)
-            worksteps_copy[0]["date"] = trt_no_to_plant[trt_no]["PDATE"]
-            ld = worksteps_copy[-1]["latest-date"]
-            worksteps_copy[-1]["latest-date"] = f"{int(trt_no_to_plant[trt_no]['PDATE'][:4])+1}{ld[4:]}"
-            worksteps_copy[0]["PlantDensity"] = int(trt_no_to_plant[trt_no]["PLPOP"])
-
-            for date in sorted(dates):
-                if date in trt_no_to_fertilizers[trt_no]:
-                    worksteps_copy.insert(-1, copy.deepcopy(trt_no_to_fertilizers[trt_no][date]))
-                if date in trt_no_to_irrigation[trt_no]:
-                    worksteps_copy.insert(-1, copy.deepcopy(trt_no_to_irrigation[trt_no][date]))
-
-            env_template["cropRotation"][0]["worksteps"] = worksteps_copy
-
-            env_template["customId"] = {
+            ld = worksteps[-1]["latest-date"]
+            env_values["worksteps"] = env_assembly.assemble_worksteps(
+                sowing_tmpl.encode({
+                    "date": trt_no_to_plant[trt_no]["PDATE"],
+                    "PlantDensity": int(trt_no_to_plant[trt_no]["PLPOP"])
+                }),
+                static_ws_jsons,
+                trt_no_to_events_json.get(trt_no, ""),
+                harvest_tmpl.encode({
+                    "latest-date": f"{int(trt_no_to_plant[trt_no]['PDATE'][:4])+1}{ld[4:]}"
+                }))
+
+            custom_id = {
                 "nodata": False,
                 "trt_no": int(trt_no),
-                "soil_name": meta["SOIL_ID"]
+                "soil_name": meta["SOIL_ID"],
+                **candidate_id
             }
-            socket.send_json(env_template)
+            cached_result = None
+            if cache:
+                env_values["customId"] = None
+                custom_id["env_key"] = result_cache.env_key(env_tmpl.encode_bytes(env_values))
+                cached_result = cache.get(custom_id["env_key"])
+            env_values["customId"] = custom_id
+            if cached_result:
+                # the consumer gets the result without MONICA being involved
+                custom_id["cached"] = True
+                jobs.append((cache_socket, json.dumps(result_cache.decode_result(cached_result, custom_id)).encode("utf8"),
+                             int(trt_no)))
+            else:
+                env_bytes = env_tmpl.encode_bytes(env_values)
+                if stats:
+                    s = stats.stop(trt_no, len(trt_no_to_events.get(trt_no, ())), len(env_bytes))
+                    print(f"{os.path.basename(__file__)} {stats.format(s)}")
+                jobs.append((socket, env_bytes, int(trt_no)))
             #with open(f"out/env_template_trt_no-{trt_no}_iter_count-{iter_count}.json", "w") as _:
-            #    json.dump(env_template, _, indent=2)
+            #    _.write(env_tmpl.encode(env_values))
             #iter_count += 1
+
+        return jobs, sent_trt_nos, soil_name, cancelled
+
+    async def announce(candidate_id, job, sent_trt_nos):
+        "tell the consumer that the job (trt_no or 'done') of the candidate has been sent"
+        if announce_socket:
+            await announce_socket.send_json({"customId": {**candidate_id, "announce": True, "job": job,
+                                                          "trt_nos": sent_trt_nos}})
+
+    async def send_envs(params, candidate_id, trt_nos=None, candidate_trt_nos=None):
+        """
+        send the envs of the candidate's treatments (all or candidate_trt_nos) or just the given trt_nos of them
+        for the calibration parameters, followed by the done message,
+        other candidates can be encoded while the jobs wait for the in-flight window
+        """
+        jobs, sent_trt_nos, soil_name, cancelled = encode_envs(params, candidate_id, trt_nos, candidate_trt_nos)
+
+        no_of_trts = 0
+        for job_socket, job_bytes, trt_no in jobs:
+            if candidate_id.get("candidate", None) in cancelled_candidates:
+                # cancelled while waiting for the window
+                cancelled = True
+                break
+            await window.send(job_socket, job_bytes)
+            await announce(candidate_id, trt_no, sent_trt_nos)
             no_of_trts += 1
             print(f"{os.path.basename(__file__)} sent job {no_of_trts}")
 
-        # send done message
-        env_template["customId"] = {
+        # send done message, listing all treatments of the candidate
+        env_values["customId"] = {
             "no_of_trts": no_of_trts,
             "nodata": True,
-            "soil_name": meta["SOIL_ID"]
+            "soil_name": soil_name,
+            **candidate_id,
+            "trt_nos": sent_trt_nos
         }
-        socket.send_json(env_template)
+        if cancelled:
+            env_values["customId"]["cancelled"] = True
+        await window.send(socket, env_tmpl.encode_bytes(env_values))
+        await announce(candidate_id, "done", sent_trt_nos)
         print(f"{os.path.basename(__file__)} done")
+        print(f"{os.path.basename(__file__)} {window.format_metrics()}")
+        if stats:
+            print(f"{os.path.basename(__file__)} {stats.summary()}")
+            stats.clear()
+        if cache:
+            print(f"{os.path.basename(__file__)} {cache.format_stats()}")
+            cache.reset_stats()
+
+    # the parameters of the recent candidates, to resubmit the treatments the consumer is missing
+    candidate_to_params = OrderedDict()
+    # the recently aborted candidates
+    cancelled_candidates = OrderedDict()
+
+    async def send_candidate(params, candidate_id, candidate_trt_nos):
+        await send_envs(params, candidate_id, candidate_trt_nos=candidate_trt_nos)
+
+    async def resubmit():
+        while True:
+            req = await resubmit_socket.recv_json()
+            # the resubmission number lets the consumer tell the jobs apart from the lost ones
+            candidate_id = {k: req[k] for k in ["round", "candidate", "resubmission"] if k in req}
+            params, candidate_trt_nos = candidate_to_params.get(req.get("candidate", None), (None, None))
+            if params is None:
+                print(f"{os.path.basename(__file__)} can't resubmit unknown candidate: {candidate_id}")
+                continue
+            print(f"{os.path.basename(__file__)} resubmitting {candidate_id} trt_nos: {req.get('trt_nos', [])}")
+            await send_envs(params, candidate_id, set(req.get("trt_nos", [])), candidate_trt_nos)
+
+    resubmit_task = None
+    if resubmit_socket:
+        resubmit_task = asyncio.create_task(resubmit())
+
+    # the candidates are sent one after the other, meanwhile the reader keeps reading to get the cancellations
+    send_tasks = set()
+    # the names of the typed parameter sets, sent just with the first one
+    param_names = []
+    iter_count = 0
+    while True:
+        params = None
+        candidate_id = {}
+        candidate_trt_nos = None
+        invalid = False
+        if calibration:
+            msg = await reader.read()
+            # check for end of data from in port
+            if msg.which() == "done":
+                break
+
+            # with open(config["path_to_out"] + "/spot_setup.out", "a") as _:
+            #    _.write(f"{datetime.now()} connected\n")
+
+            try:
+                in_ip = msg.value.as_struct(fbp_capnp.IP)
+                cancel = common.get_fbp_attr(in_ip, "cancel")
+                if cancel is not None:
+                    cancelled_candidates[cancel.as_text()] = True
+                    if len(cancelled_candidates) > MAX_RESUBMITTABLE_CANDIDATES:
+                        cancelled_candidates.popitem(last=False)
+                    print(f"{os.path.basename(__file__)} cancelled candidate: {cancel.as_text()}")
+                    continue
+                content_type = common.get_fbp_attr(in_ip, "content_type")
+                if content_type is not None and content_type.as_text() == "ParamSet":
+                    param_set = in_ip.content.as_struct(calibration_capnp.ParamSet)
+                    if len(param_set.names) > 0:
+                        param_names = list(param_set.names)
+                    if len(param_names) != len(param_set.values):
+                        print(f"{os.path.basename(__file__)} error: parameter set with {len(param_set.values)} "
+                              f"values, but {len(param_names)} parameter names known, skipping it")
+                        invalid = True
+                    else:
+                        params: dict = dict(zip(param_names, param_set.values))
+                else:
+                    s: str = in_ip.content.as_text()
+                    params: dict = json.loads(s)  # keys: MaxAssimilationRate, AssimilateReallocation, RootPenetrationRate
+                # the round and candidate are passed through to the consumer to match the results
+                for attr in ["round", "candidate"]:
+                    val = common.get_fbp_attr(in_ip, attr)
+                    if val is not None:
+                        candidate_id[attr] = val.as_text()
+                # a candidate might be evaluated on a subset of the treatments only
+                val = common.get_fbp_attr(in_ip, "trt_nos")
+                if val is not None:
+                    candidate_trt_nos = set(json.loads(val.as_text()))
+                if invalid:
+                    # just the done message is sent, so the candidate is given back without results
+                    candidate_trt_nos = set()
+                elif "candidate" in candidate_id:
+                    candidate_to_params[candidate_id["candidate"]] = (params, candidate_trt_nos)
+                    if len(candidate_to_params) > MAX_RESUBMITTABLE_CANDIDATES:
+                        candidate_to_params.popitem(last=False)
+            except Exception as e:
+                print(f"{os.path.basename(__file__)} exception: {e}")
+                raise e
 
         if not calibration:
+            await send_candidate(params, candidate_id, candidate_trt_nos)
             break
 
+        for task in [t for t in send_tasks if t.done()]:
+            send_tasks.discard(task)
+            task.result()  # raise the exceptions of the finished sends
+        send_tasks.add(asyncio.create_task(send_candidate(params, candidate_id, candidate_trt_nos)))
+
+    if send_tasks:
+        await asyncio.gather(*send_tasks)
+
+    if resubmit_task:
+        resubmit_task.cancel()
+
 
 if __name__ == "__main__":
     asyncio.run(capnp.run(run_producer()))
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import numpy as np
+
+import agmip_output
+from agmip_output import SoilLayerWeights
+
+SOIL_LAYERS_CSV = """soil_profile_name,soil_layer_base_depth
+SOIL_NAME,SLLB
+A,10
+A,30
+B,20
+B,40
+B,60
+"""
+
+
+def _weights(tmp_path, no_of_layers=6, thickness=0.1):
+    path_to_csv = tmp_path / "Soil_layers.csv"
+    path_to_csv.write_text(SOIL_LAYERS_CSV)
+    path_to_sim_json = tmp_path / "sim.json"
+    path_to_sim_json.write_text(f'{{"NumberOfLayers": {no_of_layers}, "LayerThickness": [{thickness}, "m"]}}')
+    return SoilLayerWeights(str(path_to_csv), str(path_to_sim_json))
+
+
+def test_output_depths_include_the_top_depths(tmp_path):
+    weights = _weights(tmp_path)
+    assert weights.output_depths("A") == [5.0, 10.0, 30.0]
+    assert weights.output_depths("B") == [5.0, 20.0, 40.0, 60.0]
+    assert weights.output_depths("C") is None
+    assert weights.max_no_of_output_layers() == 4
+
+
+def test_weights_average_the_overlapped_simulation_layers(tmp_path):
+    weights = _weights(tmp_path).get("A")
+    assert weights.shape == (6, 3)
+    np.testing.assert_allclose(weights.sum(axis=0), 1.0)
+    np.testing.assert_allclose(weights[:, 0], [1, 0, 0, 0, 0, 0])
+    np.testing.assert_allclose(weights[:, 1], [1, 0, 0, 0, 0, 0])
+    np.testing.assert_allclose(weights[:, 2], [0, 0.5, 0.5, 0, 0, 0])
+
+
+def test_output_layers_below_the_simulated_profile_are_nan(tmp_path):
+    weights = _weights(tmp_path, no_of_layers=4).get("B")
+    assert np.isnan(weights[:, 3]).all()
+    assert not np.isnan(weights[:, :3]).any()
+
+
+def test_weights_are_created_once_per_soil(tmp_path):
+    weights = _weights(tmp_path)
+    assert weights.get("A") is weights.get("A")
+    assert weights.get("C") is None
+
+
+def test_daily_rows_are_padded_to_the_header(tmp_path):
+    weights = _weights(tmp_path).get("A")
+    columns = {"Date": ["2019-10-01", "2019-10-03"], "Stage": [1, 2], "CWAD": [1.0, 2.0], "LAI": [0.1, 0.2],
+               "TRANS": [0.0, 0.1], "ETa": [0.2, 0.3], "Roff": [0, 0], "DPER": [[0.1], [0.2]], "NLEA": [0.0, 0.0],
+               "SWC": [[0.3, 0.2, 0.4, 0, 0, 0], [0.3, 0.2, 0.2, 0, 0, 0]]}
+    rows = agmip_output.daily_rows(6, columns, weights, no_of_swc_columns=4)
+    header = agmip_output.daily_header_rows(4)
+    assert all(len(row) == len(header[1]) for row in header + rows)
+    assert rows[1][:10] == [6, 2, 2, 2.0, 0.2, 0.1, 0.3, 0, 0.2, 0.0]
+    np.testing.assert_allclose(rows[0][10:13], [0.3, 0.3, 0.3])
+    assert rows[0][13] == ""
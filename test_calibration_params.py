@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import pytest
+
+from calibration_params import quantize
+
+
+def test_values_without_step_stay_as_they_are():
+    assert quantize(0.123456) == 0.123456
+    assert quantize(0.123456, 0.0, None, 1.0) == 0.123456
+
+
+@pytest.mark.parametrize("value,low,step,high,expected", [
+    (0.123, 0.0, 0.01, 1.0, 0.12),
+    (0.126, 0.0, 0.01, 1.0, 0.13),
+    (0.7, 0.05, 0.1, 1.0, 0.65),
+    (12.0, None, 5, None, 10),
+    (0.3, 0.1, 0.1, 0.5, 0.3),
+])
+def test_values_snap_to_the_grid_starting_at_low(value, low, step, high, expected):
+    assert quantize(value, low, step, high) == expected
+
+
+def test_snapped_values_stay_within_low_and_high():
+    assert quantize(0.99, 0.0, 0.3, 1.0) == 0.9
+    assert quantize(-0.2, 0.0, 0.1, 1.0) == 0.0
+
+
+def test_floating_point_noise_is_removed():
+    assert repr(quantize(0.3, 0.0, 0.1, 1.0)) == "0.3"
+    assert repr(quantize(0.7000001, 0.0, 0.1, 1.0)) == "0.7"
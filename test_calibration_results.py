@@ -0,0 +1,50 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+import numpy as np
+import spotpy
+
+import calibration_results
+
+
+class Setup:
+    def __init__(self):
+        self.params = [spotpy.parameter.Uniform("a", 0, 1), spotpy.parameter.Uniform("b", 0, 1)]
+
+    def parameters(self):
+        return spotpy.parameter.generate(self.params)
+
+    def simulation(self, x):
+        return [x[0]]
+
+    def evaluation(self):
+        return [0.5]
+
+    def objectivefunction(self, simulation, evaluation):
+        return abs(simulation[0] - evaluation[0])
+
+
+def test_just_the_burn_in_is_seeded():
+    sampler = spotpy.algorithms.sceua(Setup(), dbformat="ram", random_state=1)
+    assert calibration_results.seed_initial_population(sampler, [{"a": 0.25, "b": 2.0}, {"a": 0.5}]) == 1
+
+    burn_in = sampler._sampleinputmatrix(3, 2)
+    # clipped to the bounds, unknown parameters keep their random sample
+    np.testing.assert_allclose(burn_in[0], [0.25, 1.0])
+    assert burn_in[1][0] == 0.5
+    # the sampler's later random points are random again
+    later = [sampler._sampleinputmatrix(1, 2)[0] for _ in range(3)]
+    assert not any(np.allclose(point, burn_in[0]) or np.allclose(point, later[0]) for point in later[1:])
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+from concurrent.futures import Future
+import json
+
+import numpy as np
+import pytest
+
+from calibration_spotpy_setup_MONICA import EvaluationCache, SpotpySetup, StreamedObjective
+
+
+OBSERVATIONS = {1: [1.0, 2.0], 2: [3.0, np.nan]}
+
+
+def test_lower_bound_without_observations_is_zero():
+    assert StreamedObjective(OBSERVATIONS, 1.0, 0).lower_bound() == 0.0
+
+
+def test_lower_bound_divides_by_all_observations():
+    objective = StreamedObjective(OBSERVATIONS, 10.0, 3)
+    assert objective.lower_bound() == 0.0
+    assert not objective.add(1, [2.0, 4.0])
+    # (1 + 4) / 3 observations, not just the 2 compared so far
+    assert objective.lower_bound() == pytest.approx(np.sqrt(5.0 / 3))
+
+
+def test_missing_observations_are_ignored():
+    objective = StreamedObjective(OBSERVATIONS, 10.0, 3)
+    objective.add(2, [1.0, 100.0])
+    assert objective.lower_bound() == pytest.approx(np.sqrt(4.0 / 3))
+
+
+def test_add_tells_when_the_threshold_cant_be_reached_anymore():
+    objective = StreamedObjective(OBSERVATIONS, 1.0, 3, sq_sum=1.0)
+    assert not objective.add(1, [1.0, 2.0])
+    assert objective.add(2, [1.0, 0.0])
+
+
+def test_duplicate_treatments_are_added_once():
+    objective = StreamedObjective(OBSERVATIONS, 10.0, 3)
+    objective.add(1, [2.0, 2.0])
+    assert not objective.add(1, [2.0, 2.0])
+    assert objective.sq_sum == 1.0
+
+
+class Params(list):
+    "like the parameter values spotpy passes to simulation"
+
+    def __init__(self, name_to_value):
+        super().__init__(name_to_value.values())
+        self.name = list(name_to_value.keys())
+
+
+def _setup(path_to_cache, results):
+    "a SpotpySetup evaluating to the given (sim_list, complete) results without MONICA"
+    setup = SpotpySetup.__new__(SpotpySetup)
+    setup.name_to_grid = {"a": (0.0, 0.1, 1.0)}
+    setup.eval_cache = EvaluationCache(str(path_to_cache), {"params": [["a", 0.0, 0.1, 1.0]]})
+    setup.evaluate = lambda msg_content: results.pop(0)
+    return setup
+
+
+def test_partial_evaluations_are_not_cached(tmp_path):
+    path_to_cache = tmp_path / "eval_cache.jsonl"
+    setup = _setup(path_to_cache, [([1.0, np.nan], False), ([1.0, 2.0], True)])
+    # e.g. an aborted candidate
+    np.testing.assert_equal(setup.simulation(Params({"a": 0.21})), [1.0, np.nan])
+    assert not path_to_cache.exists() and len(setup.eval_cache.key_to_sim) == 0
+
+    assert setup.simulation(Params({"a": 0.19})) == [1.0, 2.0]
+    lines = path_to_cache.read_text().splitlines()
+    assert [json.loads(line)["params"] for line in lines] == [{"a": 0.2}]
+    # the complete evaluation is found again
+    assert setup.simulation(Params({"a": 0.2})) == [1.0, 2.0]
+
+
+def test_partial_evaluations_are_passed_to_the_evaluations_in_flight(tmp_path):
+    cache = EvaluationCache(str(tmp_path / "eval_cache.jsonl"), {})
+    key = EvaluationCache.key({"a": 0.2})
+    assert cache.lookup(key) is None
+    in_flight = cache.lookup(key)
+    assert isinstance(in_flight, Future)
+    cache.put(key, [1.0], complete=False)
+    assert in_flight.result() == [1.0]
+    assert cache.lookup(key) is None
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import asyncio
+
+import pytest
+import zmq
+import zmq.asyncio
+
+from credit_window import CreditWindow
+
+
+class Socket:
+    "collects the sent data"
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, data):
+        self.sent.append(data)
+
+
+def test_a_bounded_window_needs_a_credit_address():
+    with pytest.raises(ValueError):
+        CreditWindow(max_in_flight=2)
+
+
+def test_unbounded_window_just_counts():
+    window = CreditWindow()
+    socket = Socket()
+
+    async def send():
+        for i in range(5):
+            await window.send(socket, str(i).encode())
+
+    asyncio.run(send())
+    assert socket.sent == [b"0", b"1", b"2", b"3", b"4"]
+    assert (window.in_flight, window.sent, window.credited) == (5, 5, 0)
+
+
+def test_credits_free_single_or_counted_slots():
+    window = CreditWindow()
+    window.in_flight = 5
+    window._credit(b"1")
+    window._credit(b"")
+    window._credit(b"2")
+    assert (window.in_flight, window.credited) == (1, 4)
+
+
+def test_send_waits_for_the_credits():
+    async def run():
+        context = zmq.asyncio.Context()
+        window = CreditWindow(context, "inproc://credits", max_in_flight=2)
+        credit_socket = context.socket(zmq.PUSH)
+        credit_socket.connect("inproc://credits")
+        socket = Socket()
+        try:
+            await window.send(socket, b"1")
+            await window.send(socket, b"2")
+            third = asyncio.ensure_future(window.send(socket, b"3"))
+            await asyncio.sleep(0.05)
+            assert not third.done() and len(socket.sent) == 2
+            # e.g. two jobs lost by MONICA credited back at once
+            await credit_socket.send(b"2")
+            await asyncio.wait_for(third, 5)
+            assert socket.sent == [b"1", b"2", b"3"]
+            assert (window.in_flight, window.sent, window.credited) == (1, 3, 2)
+        finally:
+            window.close()
+            credit_socket.close()
+            context.term()
+
+    asyncio.run(run())
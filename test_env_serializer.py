@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import json
+
+import env_serializer
+from env_serializer import JsonTemplate, Raw
+
+
+ENV = {
+    "type": "Env",
+    "params": {"siteParameters": {"HeightNN": 0, "Latitude": 52.5, "SoilProfileParameters": []}},
+    "cropRotation": [{"worksteps": [{"type": "Sowing", "date": "2019-10-01"}]}],
+    "customId": None,
+    "text": "ä \"quoted\" \n"
+}
+SLOTS = {
+    "Latitude": ("params", "siteParameters", "Latitude"),
+    "worksteps": ("cropRotation", 0, "worksteps"),
+    "customId": ("customId",),
+    "missing": ("params", "missing"),
+}
+
+
+def _set(obj, path, value):
+    for key in path[:-1]:
+        obj = obj[key]
+    obj[path[-1]] = value
+
+
+def test_encode_is_byte_identical_to_json_dumps():
+    tmpl = JsonTemplate(ENV, SLOTS)
+    values = {
+        "Latitude": 47.1,
+        "worksteps": [{"type": "Harvest", "date": "2020-07-01"}],
+        "customId": {"trt_no": 6, "candidate": "1"},
+        "missing": [1.5, None, "x"],
+    }
+    expected = json.loads(json.dumps(ENV))
+    for name, value in values.items():
+        _set(expected, SLOTS[name], value)
+    assert tmpl.encode_bytes(values) == json.dumps(expected).encode("utf8")
+
+
+def test_encode_uses_the_current_values_of_missing_slots():
+    tmpl = JsonTemplate(ENV, SLOTS)
+    # missing dict keys are appended
+    expected = dict(ENV, params={"siteParameters": ENV["params"]["siteParameters"], "missing": None})
+    assert tmpl.encode({}) == json.dumps(expected)
+
+
+def test_raw_values_are_spliced_in_as_is():
+    tmpl = JsonTemplate(ENV, SLOTS)
+    worksteps = [{"type": "Sowing"}, {"type": "Harvest"}]
+    raw = env_serializer.encode_list([json.dumps(ws) for ws in worksteps])
+    assert isinstance(raw, Raw)
+    assert tmpl.encode({"worksteps": raw}) == tmpl.encode({"worksteps": worksteps})
+
+
+def test_the_template_obj_is_not_changed():
+    before = json.dumps(ENV)
+    JsonTemplate(ENV, SLOTS).encode({"Latitude": 1.0})
+    assert json.dumps(ENV) == before
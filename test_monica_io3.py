@@ -0,0 +1,64 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import monica_io3
+
+
+def _oid(name, from_layer=-1, to_layer=-1, layer_agg_op=monica_io3.OP_NONE):
+    return {"name": name, "displayName": "", "fromLayer": from_layer, "toLayer": to_layer,
+            "organ": monica_io3.ORGAN_UNDEFINED_ORGAN_, "layerAggOp": layer_agg_op}
+
+
+OUTPUT_IDS = [_oid("Date"), _oid("LAI"), _oid("SWC", 0, 2)]
+
+
+def test_output_columns_of_obj_results():
+    results = [{"Date": "2019-10-01", "LAI": 0.1, "SWC": [0.3, 0.3, 0.3]},
+               {"Date": "2019-10-02", "LAI": 0.2, "SWC": [0.2, 0.3, 0.4]}]
+    assert monica_io3.output_columns(OUTPUT_IDS, results) == {
+        "Date": ["2019-10-01", "2019-10-02"], "LAI": [0.1, 0.2], "SWC": [[0.3, 0.3, 0.3], [0.2, 0.3, 0.4]]}
+
+
+def test_output_columns_of_column_results():
+    results = [["2019-10-01", "2019-10-02"], [0.1, 0.2], [[0.3, 0.3, 0.3], [0.2, 0.3, 0.4]]]
+    assert monica_io3.output_columns(OUTPUT_IDS, results) == {
+        "Date": ["2019-10-01", "2019-10-02"], "LAI": [0.1, 0.2], "SWC": [[0.3, 0.3, 0.3], [0.2, 0.3, 0.4]]}
+
+
+def test_output_columns_without_output_ids_use_the_first_rows_keys():
+    assert monica_io3.output_columns([], [{"GWAD": 5, "CWAD": 9}]) == {"GWAD": [5], "CWAD": [9]}
+
+
+def test_output_columns_prefer_the_display_name():
+    oid = dict(_oid("Yield"), displayName="GWAD")
+    assert monica_io3.output_columns([oid], [[5.0]]) == {"GWAD": [5.0]}
+
+
+def test_first_row_of_both_layouts():
+    assert monica_io3.first_row(OUTPUT_IDS[:2], [["2019-10-01"], [0.1]]) == {"Date": "2019-10-01", "LAI": 0.1}
+    assert monica_io3.first_row(OUTPUT_IDS[:2], [{"Date": "2019-10-01", "LAI": 0.1}]) == \
+        {"Date": "2019-10-01", "LAI": 0.1}
+    assert monica_io3.first_row(OUTPUT_IDS[:2], [[], []]) == {}
+
+
+def test_iter_output_rows_of_both_layouts():
+    objs = [{"Date": "2019-10-01", "LAI": 0.1}, {"Date": "2019-10-02", "LAI": 0.2}]
+    columns = [["2019-10-01", "2019-10-02"], [0.1, 0.2]]
+    rows = list(monica_io3.iter_output_rows(OUTPUT_IDS[:2], objs))
+    assert rows == list(monica_io3.iter_output_obj(OUTPUT_IDS[:2], objs))
+    assert rows == list(monica_io3.iter_output_rows(OUTPUT_IDS[:2], columns))
+    assert len(rows) == 2
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+import result_cache
+from result_cache import ResultCache
+
+
+def test_env_key_hashes_the_encoded_env():
+    assert result_cache.env_key(b'{"a": 1}') == result_cache.env_key('{"a": 1}')
+    assert result_cache.env_key(b'{"a": 1}') != result_cache.env_key(b'{"a": 2}')
+
+
+def test_results_roundtrip_with_their_custom_id():
+    msg = {"customId": {"trt_no": 1}, "data": [{"results": [{"GWAM": 1.0}]}], "errors": []}
+    encoded = result_cache.encode_result(msg)
+    assert b"customId" not in encoded
+    assert result_cache.decode_result(encoded, {"trt_no": 2}) == dict(msg, customId={"trt_no": 2})
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache.sqlite"), max_bytes=1000)
+    for i in range(10):
+        cache.put(f"k{i}", b"x" * 100)
+    assert cache.size() == (10, 1000) and cache.evicted == 0
+    assert cache.get("k0") is not None
+
+    cache.put("k10", b"x" * 100)
+    # evicted down to 90 % of max_bytes, k0 has just been used
+    assert cache.size() == (9, 900)
+    assert cache.total_bytes == 900
+    assert cache.evicted == 2
+    assert cache.get("k0") is not None
+    assert cache.get("k1") is None and cache.get("k2") is None
+    cache.close()
+
+
+def test_the_running_total_is_shared_by_all_writers(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = ResultCache(path, max_bytes=1000)
+    other = ResultCache(path, max_bytes=1000)
+    for i in range(6):
+        cache.put(f"a{i}", b"x" * 100)
+        other.put(f"b{i}", b"x" * 100)
+        assert cache.size()[1] <= 1000
+    # replacing a result counts just its new size
+    other.put("b5", b"x" * 50)
+    assert other.total_bytes == cache.size()[1]
+    cache.close()
+    other.close()
+
+    reopened = ResultCache(path, max_bytes=1000)
+    assert reopened.total_bytes == reopened.size()[1]
+    reopened.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+# -*- coding: UTF-8
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/. */
+
+# Authors:
+# Michael Berg-Mohnicke <michael.berg@zalf.de>
+#
+# Maintainers:
+# Currently maintained by the authors.
+#
+# This file has been created at the Institute of
+# Landscape Systems Analysis at the ZALF.
+# Copyright (C: Leibniz Centre for Agricultural Landscape Research (ZALF)
+
+# Binary weather store
+# --------------------
+# magic (4 bytes) | version (uint32) | header size (uint32) | json header | padding | data
+# the json header holds the variable names and per station the first day (ordinal), the number of days
+# and the first row in the data block, the data block is a dense float32 array (rows = days, cols = variables),
+# missing days are NaN
+
+from datetime import date
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+import experiment_tables
+import monica_io3
+
+MAGIC = b"AGWS"
+VERSION = 1
+ALIGNMENT = 64
+VARIABLES = ["SRAD", "TMAX", "TMIN", "RAIN", "WIND", "RHAVD"]
+
+
+def convert_weather_csvs(paths_to_csvs, path_to_store, variables=VARIABLES):
+    "convert AgMIP daily weather csv files (WST_ID, W_DATE, variables ...) into a single weather store file"
+    stations = {}
+    blocks = []
+    row_offset = 0
+    for path in paths_to_csvs:
+        table = experiment_tables.load_table(path, skip_lines=0)
+        for wst_id, rows in table.index("WST_ID").items():
+            if wst_id in stations:
+                raise ValueError(f"Weather station {wst_id} found in more than one file ({path})!")
+            ordinals = (table["W_DATE"][rows] - np.datetime64("0001-01-01")).astype(np.int64) + 1
+            first = int(ordinals.min())
+            no_of_days = int(ordinals.max()) - first + 1
+            block = np.full((no_of_days, len(variables)), np.nan, dtype=np.float32)
+            for col, var in enumerate(variables):
+                if var in table.columns:
+                    block[ordinals - first, col] = table[var][rows]
+            stations[str(wst_id)] = {"first_ordinal": first, "no_of_days": no_of_days, "row_offset": row_offset}
+            blocks.append(block)
+            row_offset += no_of_days
+
+    header = json.dumps({"variables": list(variables), "no_of_rows": row_offset, "stations": stations}).encode("utf-8")
+    prefix_size = len(MAGIC) + 8 + len(header)
+    padding = (-prefix_size) % ALIGNMENT
+    tmp_path = f"{path_to_store}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as _:
+        _.write(MAGIC)
+        _.write(struct.pack("<II", VERSION, len(header)))
+        _.write(header)
+        _.write(b"\0" * padding)
+        for block in blocks:
+            _.write(block.astype("<f4").tobytes())
+    os.replace(tmp_path, path_to_store)
+
+
+class WeatherStore:
+    "read only, memory mapped access to a weather store file, slices are views into the mapped file"
+
+    def __init__(self, path_to_store):
+        with open(path_to_store, "rb") as _:
+            magic = _.read(len(MAGIC))
+            if magic != MAGIC:
+                raise ValueError(f"{path_to_store} is not a weather store file!")
+            version, header_size = struct.unpack("<II", _.read(8))
+            if version != VERSION:
+                raise ValueError(f"{path_to_store} has unsupported weather store version {version}!")
+            header = json.loads(_.read(header_size).decode("utf-8"))
+        prefix_size = len(MAGIC) + 8 + header_size
+        data_offset = prefix_size + (-prefix_size) % ALIGNMENT
+        self.variables = header["variables"]
+        self.var_to_col = {v: i for i, v in enumerate(self.variables)}
+        self.stations = header["stations"]
+        self.data = np.memmap(path_to_store, dtype="<f4", mode="r", offset=data_offset,
+                              shape=(header["no_of_rows"], len(self.variables)))
+        self._climate_data_json = {}
+
+    def date_range(self, wst_id):
+        "first and last date of the station"
+        s = self.stations[wst_id]
+        return date.fromordinal(s["first_ordinal"]), date.fromordinal(s["first_ordinal"] + s["no_of_days"] - 1)
+
+    def _row_slice(self, wst_id, start_date=None, end_date=None):
+        s = self.stations[wst_id]
+        first = s["first_ordinal"]
+        start = max(0, start_date.toordinal() - first) if start_date else 0
+        end = min(s["no_of_days"], end_date.toordinal() - first + 1) if end_date else s["no_of_days"]
+        return slice(s["row_offset"] + start, s["row_offset"] + max(start, end)), date.fromordinal(first + start)
+
+    def series(self, wst_id, start_date=None, end_date=None):
+        "(days x variables view, date of the first row) for the station and the date range (inclusive)"
+        rows, first_date = self._row_slice(wst_id, start_date, end_date)
+        return self.data[rows], first_date
+
+    def variable(self, wst_id, var, start_date=None, end_date=None):
+        "view of a single variable of the station for the date range (inclusive)"
+        rows, _ = self._row_slice(wst_id, start_date, end_date)
+        return self.data[rows, self.var_to_col[var]]
+
+    def climate_data(self, wst_id, csv_options):
+        """
+        the climate data of the station as json representation of MONICA's DataAccessor (like
+        monica_io3.read_climate_data_from_csv_string), the variables are mapped via header-to-acd-names
+        """
+        start = csv_options.get("start-date", "")
+        end = csv_options.get("end-date", "")
+        block, first_date = self.series(wst_id,
+                                        date.fromisoformat(start) if start else None,
+                                        date.fromisoformat(end) if end else None)
+        if len(block) == 0:
+            raise ValueError(f"Weather store has no data for {wst_id} in the configured date range!")
+        if np.isnan(block).any():
+            raise ValueError(f"Weather store data for {wst_id} is not continuous!")
+
+        h2c = monica_io3._header_to_acd_conversion(csv_options.get("header-to-acd-names", {}))
+        acd_to_values = {}
+        for var, col in self.var_to_col.items():
+            acd_name, conv = h2c.get(var, (var, None))
+            if acd_name not in monica_io3.ACD_NAME_TO_ID:
+                continue
+            # the shortest float32 repr gives back the values as written in the csv
+            vals = block[:, col].astype(str).astype(np.float64).tolist()
+            acd_to_values[monica_io3.ACD_NAME_TO_ID[acd_name]] = [conv(v) for v in vals] if conv else vals
+
+        tavg = monica_io3.ACD_NAME_TO_ID["tavg"]
+        tmin = monica_io3.ACD_NAME_TO_ID["tmin"]
+        tmax = monica_io3.ACD_NAME_TO_ID["tmax"]
+        if tavg not in acd_to_values and tmin in acd_to_values and tmax in acd_to_values:
+            acd_to_values[tavg] = [(mi + ma) / 2.0 for mi, ma in zip(acd_to_values[tmin], acd_to_values[tmax])]
+
+        return {
+            "type": "DataAccessor",
+            "data": {str(acd): vals for acd, vals in sorted(acd_to_values.items())},
+            "startDate": first_date.isoformat(),
+            "endDate": date.fromordinal(first_date.toordinal() + len(block) - 1).isoformat(),
+            "fromStep": 0,
+            "numberOfSteps": len(block)
+        }
+
+    def climate_data_json(self, wst_id, csv_options):
+        "json encoded climate_data, cached per station and options"
+        key = (wst_id, json.dumps(csv_options, sort_keys=True))
+        if key not in self._climate_data_json:
+            self._climate_data_json[key] = json.dumps(self.climate_data(wst_id, csv_options))
+        return self._climate_data_json[key]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print(f"usage: {os.path.basename(__file__)} path/to/Weather_daily_1.csv [...] path/to/weather.store")
+        exit(1)
+    convert_weather_csvs(sys.argv[1:-1], sys.argv[-1])
+    store = WeatherStore(sys.argv[-1])
+    for wst_id in store.stations:
+        print(wst_id, *store.date_range(wst_id))